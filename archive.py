@@ -0,0 +1,403 @@
+import atexit
+import datetime
+import glob
+import gzip
+from optparse import OptionParser
+import os
+import queue
+from queue import Empty
+import simplejson as json
+import sqlite3
+import threading
+import time
+import zlib
+
+
+def safe_filename(filename):
+    """Returns the filename without characters that are not allowed in filenames.
+    """
+    return (filename.replace(' ', '-')
+                    .replace(';', '')
+                    .replace(':', '')
+                    .replace('\\', '')
+                    .replace('/', '')
+                    .replace('*', '')
+                    .replace('?', '')
+                    .replace('"', '')
+                    .replace('<', '')
+                    .replace('>', '')
+                    .replace('|', '')
+                    .replace("'", ''))
+
+def segment_path(directory, segment):
+    return os.path.join(directory, 'games-{:06d}.jsonl.gz'.format(segment))
+
+# Columns of the index, i.e. the position (the order of writing from 1), the id, the players, the date and the location of each game.
+INDEX_COLUMNS = ['position', 'id', 'player1', 'player2', 'date', 'index', 'gameover', 'segment', 'offset', 'line']
+
+def index_path(directory):
+    return os.path.join(directory, 'index.sqlite3')
+
+def open_index(directory):
+    """Open the index of the archive, and create it if it does not exist.
+
+    The index is a SQLite database on disk, so games are found by their ids, positions, players or dates
+    without loading the index in memory.
+    """
+    index = sqlite3.connect(index_path(directory), check_same_thread=False)
+    index.execute('PRAGMA journal_mode=WAL')
+
+    with index:
+        index.execute('CREATE TABLE IF NOT EXISTS games ('
+                      'position INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, player1 TEXT, player2 TEXT, date TEXT, '
+                      '"index" INTEGER, gameover TEXT, segment INTEGER, "offset" INTEGER, line INTEGER)')
+        index.execute('CREATE INDEX IF NOT EXISTS games_players ON games (player1, player2)')
+        index.execute('CREATE INDEX IF NOT EXISTS games_date ON games (date)')
+
+    return index
+
+def insert_entries(index, entries):
+    columns = INDEX_COLUMNS[1:]
+    index.executemany('INSERT INTO games ({}) VALUES ({})'.format(', '.join('"{}"'.format(column) for column in columns),
+                                                                  ', '.join('?' for _ in columns)),
+                      ([entry[column] for column in columns] for entry in entries))
+
+def find_entries(index, player1=None, player2=None, since=None, until=None):
+    """Find games in the index by their players and dates.
+
+    # Arguments
+        index: The connection to the index.
+        player1: The name of the first player, or None for any player.
+        player2: The name of the second player, or None for any player.
+        since: The first date of the games (e.g. `2026-10-18`), or None.
+        until: The date the games are before (e.g. `2026-10-19`), or None.
+
+    # Returns
+        The entries of the games, in the order of writing.
+    """
+    conditions = []
+    params = []
+    for (condition, value) in [('player1 = ?', player1), ('player2 = ?', player2), ('date >= ?', since), ('date < ?', until)]:
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+
+    query = 'SELECT * FROM games'
+    if len(conditions) > 0:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    rows = index.execute(query + ' ORDER BY position', params)
+    return [dict(zip(INDEX_COLUMNS, row)) for row in rows]
+
+def read_segments(directory):
+    """Read the records of all the games in the archive and the archives in its subdirectories (e.g. of shards),
+    in the order of writing.
+    """
+    for path in sorted(glob.glob(os.path.join(directory, '**', 'games-*.jsonl.gz'), recursive=True)):
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                yield json.loads(line)
+
+def load_record(directory, entry):
+    """Read the record of a game.
+
+    # Arguments
+        directory: The directory of the archive.
+        entry: The entry of the game in the index.
+    """
+    # Each batch is a gzip member beginning at the offset, so only the batch is decompressed.
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    data = b''
+
+    with open(segment_path(directory, entry['segment']), 'rb') as f:
+        f.seek(entry['offset'])
+        while not decompressor.eof:
+            chunk = f.read(65536)
+            if len(chunk) == 0:
+                break
+            data += decompressor.decompress(chunk)
+
+    line = data.split(b'\n')[entry['line']]
+    return json.loads(line.decode('utf-8'))
+
+class Archive:
+    """Append-only store of finished games.
+
+    Records of games are appended to gzip compressed JSON lines files by a background thread in batches.
+    A segment file is rotated every `segment_games` games, and the index (`index.sqlite3`) tells where each game is.
+    """
+    def __init__(self, directory='log/archive', segment_games=1000, batch_size=100, flush_interval=1.0):
+        self.directory = directory
+        self.segment_games = segment_games
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        os.makedirs(directory, exist_ok=True)
+
+        # The index, read by the handlers. The background thread writes it with its own connection.
+        self.index = open_index(directory)
+
+        # Ids of the games in the queue.
+        self.pending = set()
+
+        # Start a new segment, so that a batch cut off by a crash never precedes new batches.
+        segments = glob.glob(os.path.join(directory, 'games-*.jsonl.gz'))
+        self.segment = 1 + max([int(os.path.basename(path)[len('games-'):-len('.jsonl.gz')]) for path in segments], default=0)
+        self.segment_count = 0
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        atexit.register(self.close)
+
+    def add(self, game):
+        """Archive the game.
+
+        The record is written by the background thread, so this returns at once.
+
+        # Arguments
+            game: Game class.
+        """
+        record = game.record()
+        record['id'] = str(game.id)
+        record['date'] = '{0:%Y-%m-%d-%H%M%S}'.format(datetime.datetime.now())
+
+        self.pending.add(record['id'])
+        self.queue.put(record)
+
+    def is_archived(self, id):
+        """Whether the record of the game added to the archive is written.
+        """
+        return id not in self.pending
+
+    def entry(self, id):
+        """Returns the entry of the game in the index, or None if the game is not archived yet.
+        """
+        row = self.index.execute('SELECT * FROM games WHERE id = ?', (id,)).fetchone()
+        return None if row is None else dict(zip(INDEX_COLUMNS, row))
+
+    def entries(self, before, limit):
+        """Returns the entries of the games written before the position, the latest first.
+        """
+        rows = self.index.execute('SELECT * FROM games WHERE position < ? ORDER BY position DESC LIMIT ?', (before, limit))
+        return [dict(zip(INDEX_COLUMNS, row)) for row in rows]
+
+    def next_position(self):
+        """Returns the position of the next game to write.
+        """
+        return self.index.execute('SELECT COALESCE(MAX(position), 0) + 1 FROM games').fetchone()[0]
+
+    def load(self, id):
+        """Returns the record of the game, or None if the game is not archived yet.
+        """
+        entry = self.entry(id)
+        if entry is None:
+            return None
+
+        return load_record(self.directory, entry)
+
+    def run(self):
+        # The connection of this thread to the index.
+        self.writer_index = sqlite3.connect(index_path(self.directory))
+
+        closed = False
+
+        while not closed:
+            record = self.queue.get()
+            if record is None:
+                break
+
+            # Collect records for a while, and write them at once.
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except Empty:
+                    break
+
+                if record is None:
+                    closed = True
+                    break
+                batch.append(record)
+
+            self.write(batch)
+
+    def write(self, batch):
+        path = segment_path(self.directory, self.segment)
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+
+        data = ''.join(json.dumps(record) + '\n' for record in batch)
+        with open(path, 'ab') as f:
+            f.write(gzip.compress(data.encode('utf-8')))
+
+        # Index the games after they are written.
+        entries = [{
+            'id': record['id'],
+            'player1': record['player1'],
+            'player2': record['player2'],
+            'date': record['date'],
+            'index': record['index'],
+            'gameover': record['gameover'],
+            'segment': self.segment,
+            'offset': offset,
+            'line': line
+        } for (line, record) in enumerate(batch)]
+
+        with self.writer_index:
+            insert_entries(self.writer_index, entries)
+
+        for entry in entries:
+            self.pending.discard(entry['id'])
+
+        self.segment_count += len(batch)
+        if self.segment_count >= self.segment_games:
+            self.segment += 1
+            self.segment_count = 0
+
+    def close(self):
+        """Write the remaining records, and stop the background thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+class CheckpointWriter:
+    """Writes small files (e.g. checkpoints of tournaments) on a background thread, so that handlers never wait for the disk.
+
+    Each file is replaced atomically, so a crash never leaves a broken file.
+    If files are given faster than they are written, only the latest content of each file is written.
+    """
+    def __init__(self):
+        # The latest content of each file to write, or None to remove the file.
+        self.pending = { }
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def write(self, path, data):
+        """Replace the file with the data.
+
+        # Arguments
+            path: The path of the file.
+            data: The content of the file, or None to remove the file.
+        """
+        with self.condition:
+            self.pending[path] = data
+            self.condition.notify()
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def remove(self, path):
+        self.write(path, None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+
+                # The files are written in the order they are given first.
+                path = next(iter(self.pending))
+                data = self.pending.pop(path)
+
+            if path is None:
+                break
+
+            if data is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+
+            with open(path + '.tmp', 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+
+    def close(self):
+        """Write the remaining files, and stop the background thread.
+        """
+        with self.condition:
+            if self.thread is None:
+                return
+
+            # Note: None is the last file to write.
+            self.pending[None] = None
+            self.condition.notify()
+
+        self.thread.join()
+
+# Checkpoints of this process.
+checkpoints = CheckpointWriter()
+
+def find_records(directory, **conditions):
+    """Read the records of the games found in the index of the archive and the archives in its subdirectories (e.g. of shards).
+
+    # Arguments
+        directory: The directory of the archive.
+        conditions: The players and the dates of the games (see find_entries).
+    """
+    for path in sorted(glob.glob(os.path.join(directory, '**', 'index.sqlite3'), recursive=True)):
+        archive_directory = os.path.dirname(path)
+        index = open_index(archive_directory)
+
+        for entry in find_entries(index, **conditions):
+            yield load_record(archive_directory, entry)
+
+        index.close()
+
+def export(directory, output, player1=None, player2=None, since=None, until=None):
+    """Write the games of the archive as JSON files in the output directory,
+    in the layout of log/games, i.e. `<date>_<player1>_<player2>.json`.
+
+    # Arguments
+        directory: The directory of the archive.
+        output: The directory to write the games in.
+        player1, player2, since, until: If any of them is given, only the games found by them in the index (see find_entries).
+
+    # Returns
+        The number of the games written.
+    """
+    os.makedirs(output, exist_ok=True)
+
+    if player1 is None and player2 is None and since is None and until is None:
+        records = read_segments(directory)
+    else:
+        records = find_records(directory, player1=player1, player2=player2, since=since, until=until)
+
+    count = 0
+    for record in records:
+        filename = safe_filename('{}_{}_{}'.format(record.pop('date'), record['player1'], record['player2']))
+        del record['id']
+
+        # Games that end in the same second get numbered.
+        path = os.path.join(output, filename + '.json')
+        number = 1
+        while os.path.exists(path):
+            number += 1
+            path = os.path.join(output, '{}_{}.json'.format(filename, number))
+
+        with open(path, 'w') as f:
+            f.write(json.dumps(record, indent=4))
+        count += 1
+
+    return count
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-a', '--archive', dest='archive', help='directory of the archive', default='log/archive')
+    parser.add_option('-o', '--output', dest='output', help='directory to write the games in', default='log/games')
+    parser.add_option('--player1', dest='player1', help='export only the games of the first player', default=None)
+    parser.add_option('--player2', dest='player2', help='export only the games of the second player', default=None)
+    parser.add_option('--since', dest='since', help='export only the games on or after the date, e.g. 2026-10-18', default=None)
+    parser.add_option('--until', dest='until', help='export only the games before the date, e.g. 2026-10-19', default=None)
+
+    (options, args) = parser.parse_args()
+
+    count = export(options.archive, options.output, options.player1, options.player2, options.since, options.until)
+    print('INFO: Exported', count, 'games to', options.output)
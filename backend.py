@@ -0,0 +1,255 @@
+import asyncio
+import concurrent.futures
+import eventlet
+import eventlet.tpool
+import http
+import queue
+import socketio
+import threading
+import traceback
+import urllib.parse
+
+
+class EventletBackend:
+    """Socket.IO server served by eventlet.
+
+    Handlers run on green threads of eventlet.
+    """
+    def __init__(self):
+        self.sio = socketio.Server()
+
+    def on(self, event, namespace=None):
+        return self.sio.on(event, namespace=namespace)
+
+    def event(self, handler):
+        return self.on(handler.__name__)(handler)
+
+    def emit(self, event, data=None, room=None, namespace=None):
+        self.sio.emit(event, data, room=room, namespace=namespace)
+
+    def enter_room(self, sid, room, namespace=None):
+        self.sio.enter_room(sid, room, namespace=namespace)
+
+    def every(self, interval, handler):
+        """Call the handler every interval seconds while serving.
+        """
+        def run():
+            while True:
+                eventlet.sleep(interval)
+                try:
+                    handler()
+                except Exception:
+                    traceback.print_exc()
+
+        eventlet.spawn(run)
+
+    def blocking(self, function, *args):
+        """Call a function that waits for something other than the handlers, e.g. a request to another server.
+
+        The function runs on a native thread, so other green threads run until it returns.
+        """
+        return eventlet.tpool.execute(function, *args)
+
+    def serve(self, port, static_files, routes=None):
+        """Serve the socket.io server, the static files and the HTTP routes.
+
+        # Arguments
+            port: The port to listen.
+            static_files: The static file mapping rules.
+            routes: Dictionary from paths to functions that take the query parameters,
+                and return the content type and the body of the response (and the status code if it is not 200).
+        """
+        sio_app = socketio.WSGIApp(self.sio, static_files=static_files)
+        routes = routes or { }
+
+        def app(environ, start_response):
+            route = routes.get(environ['PATH_INFO'])
+            if route is None:
+                return sio_app(environ, start_response)
+
+            query = dict(urllib.parse.parse_qsl(environ.get('QUERY_STRING', '')))
+            content_type, body, *status = route(query)
+            status = http.HTTPStatus(status[0] if status else 200)
+
+            start_response('{} {}'.format(status.value, status.phrase), [('Content-Type', content_type)])
+            return [body.encode('utf-8')]
+
+        eventlet.wsgi.server(eventlet.listen(('', port)), app, log_output=False)
+
+class AsyncManager(socketio.AsyncManager):
+    """Client manager of the asyncio server.
+
+    python-socketio 4.x waits for the messages to a room with bare coroutines,
+    which asyncio.wait no longer accepts since Python 3.11, so the messages are sent as tasks.
+    """
+    async def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, **kwargs):
+        if namespace not in self.rooms or room not in self.rooms[namespace]:
+            return
+
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+
+        tasks = []
+        for sid in self.get_participants(namespace, room):
+            if sid in skip_sid:
+                continue
+
+            id = None if callback is None else self._generate_ack_id(sid, namespace, callback)
+            tasks.append(asyncio.ensure_future(self.server._emit_internal(sid, event, data, namespace, id)))
+
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+
+def settle(future, result, exception):
+    """Set the result of the handler to the future of the event loop.
+    """
+    if future.cancelled():
+        return
+
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+def report_failure(future):
+    """Print the exception of the future, e.g. of a message that could not be sent.
+    """
+    if not future.cancelled() and future.exception() is not None:
+        exception = future.exception()
+        traceback.print_exception(type(exception), exception, exception.__traceback__)
+
+class AsyncioBackend:
+    """Socket.IO server served by asyncio.
+
+    Handlers run one at a time on a worker thread, so that CPU heavy calls of minishogilib
+    (e.g. generate_moves, to_svg or is_repetition) never block the event loop,
+    and the event loop keeps receiving messages of other games while a handler runs.
+
+    While a handler waits in `blocking`, the worker thread runs the next handlers, as green threads of eventlet do.
+    """
+    def __init__(self):
+        self.sio = socketio.AsyncServer(async_mode='asgi', client_manager=AsyncManager())
+        self.loop = asyncio.new_event_loop()
+
+        # Handlers share the state of games, so they run on a single thread.
+        self.tasks = queue.Queue()
+        self.worker = threading.Thread(target=self.work, daemon=True)
+
+        # Blocking calls run on other threads.
+        self.executor = concurrent.futures.ThreadPoolExecutor()
+
+        # Periodic tasks started when serving.
+        self.periodic = []
+
+    def on(self, event, namespace=None):
+        def decorator(handler):
+            async def run(*args):
+                return await self.submit(handler, *args)
+
+            self.sio.on(event, namespace=namespace)(run)
+            return handler
+
+        return decorator
+
+    def event(self, handler):
+        return self.on(handler.__name__)(handler)
+
+    def emit(self, event, data=None, room=None, namespace=None):
+        # Handlers run on the worker thread, so the message is sent by the event loop.
+        future = asyncio.run_coroutine_threadsafe(self.sio.emit(event, data, room=room, namespace=namespace), self.loop)
+        future.add_done_callback(report_failure)
+
+    def enter_room(self, sid, room, namespace=None):
+        self.loop.call_soon_threadsafe(lambda: self.sio.enter_room(sid, room, namespace=namespace))
+
+    def submit(self, function, *args):
+        """Run the function on the worker thread.
+
+        # Returns
+            The future of the event loop that has the result of the function.
+        """
+        future = self.loop.create_future()
+        self.tasks.put((function, args, future))
+        return future
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            # Note: None only wakes up a blocking call.
+            if task is not None:
+                self.run_task(task)
+
+    def run_task(self, task):
+        function, args, future = task
+        try:
+            result = function(*args)
+        except Exception as exception:
+            self.loop.call_soon_threadsafe(settle, future, None, exception)
+        else:
+            self.loop.call_soon_threadsafe(settle, future, result, None)
+
+    def blocking(self, function, *args):
+        """Call a function that waits for something other than the handlers, e.g. a request to another server.
+
+        The function runs on another thread, and the worker thread runs the next handlers until it returns.
+        """
+        future = self.executor.submit(function, *args)
+        future.add_done_callback(lambda future: self.tasks.put(None))
+
+        while not future.done():
+            task = self.tasks.get()
+            if task is not None:
+                self.run_task(task)
+
+        return future.result()
+
+    def every(self, interval, handler):
+        """Call the handler every interval seconds while serving.
+
+        The handler runs on the worker thread like the other handlers.
+        """
+        async def run():
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.submit(handler)
+                except Exception:
+                    traceback.print_exc()
+
+        self.periodic.append(run)
+
+    def serve(self, port, static_files, routes=None):
+        """Serve the socket.io server, the static files and the HTTP routes.
+
+        # Arguments
+            port: The port to listen.
+            static_files: The static file mapping rules.
+            routes: Dictionary from paths to functions that take the query parameters,
+                and return the content type and the body of the response (and the status code if it is not 200).
+        """
+        import uvicorn
+
+        sio_app = socketio.ASGIApp(self.sio, static_files=static_files)
+        routes = routes or { }
+
+        async def app(scope, receive, send):
+            route = routes.get(scope['path']) if scope['type'] == 'http' else None
+            if route is None:
+                await sio_app(scope, receive, send)
+                return
+
+            query = dict(urllib.parse.parse_qsl(scope['query_string'].decode('utf-8')))
+            content_type, body, *status = await self.submit(route, query)
+
+            await send({'type': 'http.response.start',
+                        'status': status[0] if status else 200,
+                        'headers': [(b'Content-Type', content_type.encode('utf-8'))]})
+            await send({'type': 'http.response.body', 'body': body.encode('utf-8')})
+
+        server = uvicorn.Server(uvicorn.Config(app, host='0.0.0.0', port=port, log_level='warning'))
+
+        asyncio.set_event_loop(self.loop)
+        self.worker.start()
+        for run in self.periodic:
+            self.loop.create_task(run())
+        self.loop.run_until_complete(server.serve())
@@ -0,0 +1,295 @@
+import glob
+import math
+from optparse import OptionParser
+import os
+import shutil
+import signal
+import simplejson as json
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from archive import read_segments
+
+def process_tree(pid):
+    """Returns the process ids of the process and all of its descendants.
+    """
+    children = { }
+    for stat_path in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat_path) as f:
+                stat = f.read()
+        except OSError:
+            continue
+
+        # The command name may contain spaces, so split after it.
+        fields = stat[stat.rindex(')') + 2:].split()
+        children.setdefault(int(fields[1]), []).append(int(stat[:stat.index(' ')]))
+
+    pids = [pid]
+    for p in pids:
+        pids.extend(children.get(p, []))
+
+    return pids
+
+def cpu_seconds(pids):
+    """Returns the CPU time (user and system) the processes consumed in seconds.
+    """
+    ticks = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        ticks += int(fields[11]) + int(fields[12])
+
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+def rss_bytes(pids):
+    """Returns the resident set size of the processes in bytes.
+    """
+    rss = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+
+    return rss
+
+def percentile(values, p):
+    """Returns the p-th percentile of the values by the nearest-rank method.
+    """
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def move_latencies(trace_dir):
+    """Returns the round trip time of each move in milliseconds.
+
+    The round trip of a move is from when an engine sends `bestmove`
+    to when the opponent engine gets `go` for the position after the move,
+    i.e. through the client, the server and the client of the opponent.
+    """
+    sent = { }
+    received = []
+
+    for trace_path in glob.glob(os.path.join(trace_dir, '*.txt')):
+        with open(trace_path) as f:
+            for line in f:
+                event, timestamp, position = line.rstrip('\n').split(' ', 2)
+                if event == 'bestmove':
+                    sent.setdefault(position, []).append(float(timestamp))
+                else:
+                    received.append((float(timestamp), position))
+
+    latencies = []
+    for (timestamp, position) in received:
+        # The same position may be played in several games, so pair it with the latest move before.
+        candidates = [t for t in sent.get(position, []) if t <= timestamp]
+        if len(candidates) > 0:
+            latencies.append((timestamp - max(candidates)) * 1000)
+
+    return latencies
+
+def count_moves(archive_dir):
+    """Returns the number of games and the number of moves played in the games, read from the archive.
+    """
+    games = 0
+    moves = 0
+
+    for data in read_segments(archive_dir):
+        games += 1
+        moves += len(data['kif'].split()) - len(data['pos'].split())
+
+    return games, moves
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+
+    return False
+
+def terminate(pids, signum=signal.SIGTERM):
+    for pid in reversed(pids):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+def run(options):
+    """Play a tournament on a local server between stand-in engines, and measure the server.
+
+    # Returns
+        The dictionary of the results.
+    """
+    work_dir = tempfile.mkdtemp(prefix='minishogi-bench-')
+    os.symlink(os.path.join(ROOT, 'html'), os.path.join(work_dir, 'html'))
+    for directory in ['log/tournaments', 'trace']:
+        os.makedirs(os.path.join(work_dir, directory))
+
+    with open(options.config_json) as f:
+        config = json.load(f)
+    config['tournament'] = options.games
+
+    with open(os.path.join(work_dir, 'server.json'), 'w') as f:
+        json.dump(config, f)
+
+    engine_jsons = []
+    for player in range(2):
+        command = [sys.executable, os.path.join(ROOT, 'bench', 'random_engine.py'),
+                   '--name', 'bench{}'.format(player + 1),
+                   '--trace', os.path.join(work_dir, 'trace')]
+        if options.first:
+            command.append('--first')
+
+        engine_json = os.path.join(work_dir, 'engine{}.json'.format(player + 1))
+        with open(engine_json, 'w') as f:
+            json.dump({'command': ' '.join(command), 'cwd': work_dir, 'option': { }}, f)
+        engine_jsons.append(engine_json)
+
+    server_command = [sys.executable, os.path.join(ROOT, 'server.py'),
+                      '--port', str(options.port),
+                      '--config', 'server.json',
+                      '--workers', str(options.workers)]
+    if options.use_asyncio:
+        server_command.append('--asyncio')
+
+    with open(os.path.join(work_dir, 'server.log'), 'w') as server_log:
+        server = subprocess.Popen(server_command, cwd=work_dir, stdout=server_log, stderr=subprocess.STDOUT)
+
+    clients = []
+    try:
+        if not wait_for_port(options.port, 30):
+            raise RuntimeError('The server did not start. See {}.'.format(os.path.join(work_dir, 'server.log')))
+
+        server_pids = process_tree(server.pid)
+        rss_start = rss_bytes(server_pids)
+        rss_peak = rss_start
+        cpu_start = cpu_seconds(server_pids)
+        start_time = time.monotonic()
+
+        for _ in range(options.pairs):
+            for engine_json in engine_jsons:
+                client_command = [sys.executable, os.path.join(ROOT, 'client.py'),
+                                  '--port', str(options.port),
+                                  '--config', engine_json,
+                                  '--concurrency', str(options.concurrency)]
+                if options.warm:
+                    client_command.append('--warm')
+                clients.append(subprocess.Popen(client_command, cwd=work_dir, stdout=subprocess.DEVNULL))
+
+        # Wait until the tournament is finished.
+        finished = False
+        while time.monotonic() - start_time < options.timeout:
+            if len(glob.glob(os.path.join(work_dir, 'log/tournaments/*_trn.txt'))) > 0:
+                finished = True
+                break
+
+            rss_peak = max(rss_peak, rss_bytes(server_pids))
+            time.sleep(options.interval)
+
+        elapsed = time.monotonic() - start_time
+
+        server_pids = process_tree(server.pid)
+        cpu = cpu_seconds(server_pids) - cpu_start
+        rss_end = rss_bytes(server_pids)
+        rss_peak = max(rss_peak, rss_end)
+
+    finally:
+        for client in clients:
+            terminate(process_tree(client.pid))
+
+        # Interrupt the server, so that it writes the rest of the archive before exiting.
+        terminate(process_tree(server.pid), signal.SIGINT)
+        try:
+            server.wait(30)
+        except subprocess.TimeoutExpired:
+            terminate(process_tree(server.pid), signal.SIGKILL)
+
+    games, moves = count_moves(os.path.join(work_dir, 'log/archive'))
+    latencies = move_latencies(os.path.join(work_dir, 'trace'))
+
+    megabyte = 1024 * 1024
+
+    results = {
+        'finished': finished,
+        'games': games,
+        'moves': moves,
+        'elapsed_sec': elapsed,
+        'games_per_sec': games / elapsed,
+        'moves_per_sec': moves / elapsed,
+        'latency_ms': {
+            'count': len(latencies),
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if len(latencies) > 0 else None
+        },
+        'server_cpu_sec': cpu,
+        'server_cpu_ms_per_move': cpu * 1000 / moves if moves > 0 else None,
+        'server_rss_mb': {
+            'start': rss_start / megabyte,
+            'peak': rss_peak / megabyte,
+            'end': rss_end / megabyte,
+            'growth': (rss_end - rss_start) / megabyte
+        },
+        'setting': {
+            'games': options.games,
+            'pairs': options.pairs,
+            'concurrency': options.concurrency,
+            'warm': options.warm,
+            'asyncio': options.use_asyncio,
+            'workers': options.workers,
+            'first': options.first
+        }
+    }
+
+    if options.keep:
+        results['work_dir'] = work_dir
+    else:
+        shutil.rmtree(work_dir)
+
+    return results
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-c', '--config', dest='config_json', help='server config json file', default=os.path.join(ROOT, 'server.json'))
+    parser.add_option('-p', '--port', dest='port', help='port of the server', type='int', default=8765)
+    parser.add_option('-g', '--games', dest='games', help='the number of games of the tournament', type='int', default=100)
+    parser.add_option('--pairs', dest='pairs', help='the number of pairs of clients', type='int', default=1)
+    parser.add_option('-n', '--concurrency', dest='concurrency', help='the number of games each client plays at once', type='int', default=1)
+    parser.add_option('--warm', dest='warm', action='store_true', help='keep the engines alive across games', default=False)
+    parser.add_option('--asyncio', dest='use_asyncio', action='store_true', help='serve with asyncio instead of eventlet', default=False)
+    parser.add_option('-w', '--workers', dest='workers', help='the number of shard server processes', type='int', default=1)
+    parser.add_option('--first', dest='first', action='store_true', help='engines play the first legal move instead of a random one', default=False)
+    parser.add_option('--timeout', dest='timeout', help='seconds to wait for the tournament', type='float', default=600)
+    parser.add_option('--interval', dest='interval', help='seconds between samples of the memory usage', type='float', default=0.5)
+    parser.add_option('-o', '--output', dest='output', help='json file to write the results (default: stdout)', default=None)
+    parser.add_option('--keep', dest='keep', action='store_true', help='keep the working directory with the logs', default=False)
+
+    (options, args) = parser.parse_args()
+
+    results = run(options)
+
+    if options.output is None:
+        print(json.dumps(results, indent=4))
+    else:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,80 @@
+import minishogilib
+from optparse import OptionParser
+import os
+import random
+import sys
+import time
+
+
+def main(name, first, max_ply, trace_dir):
+    """A stand-in USI engine that answers a legal move at once.
+
+    # Arguments
+        name: The name of the engine.
+        first: If true, play the first legal move instead of a random one.
+        max_ply: Resign when the game reaches this ply, so that every game ends.
+        trace_dir: If set, record when `go` arrives and `bestmove` is sent in the directory.
+    """
+    position = minishogilib.Position()
+    sfen = None
+
+    trace = None
+    if trace_dir is not None:
+        trace = open(os.path.join(trace_dir, '{}.txt'.format(os.getpid())), 'a')
+
+    def send(message):
+        sys.stdout.write(message + '\n')
+        sys.stdout.flush()
+
+    for line in sys.stdin:
+        command = line.split()
+        if len(command) == 0:
+            continue
+
+        if command[0] == 'usi':
+            send('id name {}'.format(name))
+            send('id author bench')
+            send('usiok')
+
+        elif command[0] == 'isready':
+            send('readyok')
+
+        elif command[0] == 'position':
+            # position sfen <sfen> [moves <moves>]
+            sfen = ' '.join(command[2:])
+            position.set_sfen(sfen)
+
+        elif command[0] == 'go':
+            if trace is not None:
+                trace.write('go {} {}\n'.format(time.time(), sfen))
+
+            moves = position.generate_moves()
+            if len(moves) == 0 or position.get_ply() >= max_ply:
+                move = 'resign'
+            elif first:
+                move = moves[0].sfen()
+            else:
+                move = random.choice(moves).sfen()
+
+            if trace is not None:
+                trace.write('bestmove {} {}{}{}\n'.format(time.time(), sfen, ' ' if ' moves ' in sfen else ' moves ', move))
+                trace.flush()
+
+            send('bestmove {}'.format(move))
+
+        elif command[0] == 'stop':
+            send('bestmove resign')
+
+        elif command[0] == 'quit':
+            break
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--name', dest='name', help='the name of the engine', default='random')
+    parser.add_option('--first', dest='first', action='store_true', help='play the first legal move', default=False)
+    parser.add_option('--max-ply', dest='max_ply', help='resign at this ply', type='int', default=200)
+    parser.add_option('--trace', dest='trace_dir', help='directory to record the timing of moves', default=None)
+
+    (options, args) = parser.parse_args()
+
+    main(name=options.name, first=options.first, max_ply=options.max_ply, trace_dir=options.trace_dir)
@@ -1,15 +1,27 @@
-import logging
 from optparse import OptionParser
 import os
+import requests
 import simplejson as json
 import socketio
 import subprocess
 import threading
 import queue
+from queue import Empty
 import time
 import minishogilib
+from protocol import PROTOCOL_VERSION, position_checksum, split_position
 
 
+class EngineError(Exception):
+    """The USI engine exited, or did not behave as expected.
+    """
+    pass
+
+class EngineTimeout(EngineError):
+    """The USI engine did not send an expected command in time.
+    """
+    pass
+
 def send_message(engine, message, verbose=True):
     """Send message to the engine through standard input.
 
@@ -41,114 +53,852 @@ def message_reader(pipe, queue, verbose=True):
             if verbose:
                 print('<:', message)
 
-def receive_message(queue):
+    # The USI engine closed its stdout.
+    queue.put(None)
+
+def receive_message(queue, timeout=None):
     """Output message from the queue.
 
+    Block until a message arrives.
+
     # Arguments
         queue: The queue that stores outputs of stdout of the USI engine.
+        timeout: Seconds to wait for a message. If None, wait forever.
 
     # Returns
         A line of stdout of the USI engine.
+
+    # Raises
+        EngineTimeout: No message arrived within the timeout.
+        EngineError: The USI engine exited.
     """
-    while queue.empty():
-        continue
+    try:
+        message = queue.get(timeout=timeout)
+    except Empty:
+        raise EngineTimeout('The USI engine did not answer within {} seconds.'.format(timeout))
+
+    if message is None:
+        # Keep the end mark so that the following reads fail too.
+        queue.put(None)
+        raise EngineError('The USI engine exited.')
 
-    message = queue.get()
     return message
 
-def main(ip, port, config_json):
+def wait_for(queue, command, timeout=None, handlers=None):
+    """Dispatch messages from the USI engine until the command arrives.
+
+    # Arguments
+        queue: The queue that stores outputs of stdout of the USI engine.
+        command: The USI command to wait for (e.g. `usiok`, `readyok` or `bestmove`).
+        timeout: Seconds to wait for the command. If None, wait forever.
+        handlers: Dictionary from other USI commands (e.g. `id` or `info`) to functions called with the message.
+
+    # Returns
+        The message of the command split by whitespace.
+
+    # Raises
+        EngineTimeout: The command did not arrive within the timeout.
+        EngineError: The USI engine exited.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    while True:
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        try:
+            message = receive_message(queue, remaining)
+        except EngineTimeout:
+            raise EngineTimeout('The USI engine did not send `{}` within {} seconds.'.format(command, timeout))
+        output = message.split()
+
+        if len(output) == 0:
+            continue
+
+        if output[0] == command:
+            return output
+
+        if handlers is not None and output[0] in handlers:
+            handlers[output[0]](message)
+
+def parse_score(message):
+    """Parse the score of `info` command.
+
+    # Arguments
+        message: `info` command from the USI engine (e.g. `info depth 8 score cp 120 pv 2e3d`).
+
+    # Returns
+        The score from the view of the engine, i.e. `{'cp': centipawns}` or `{'mate': plies}`, or None if there is no score.
+        The plies of a mate are negative if the engine is mated, and 1 or -1 if the engine does not tell them.
+    """
+    output = message.split()
+
+    for i in range(1, len(output) - 2):
+        if output[i] == 'string':
+            # The rest is a free text.
+            break
+
+        if output[i] == 'score':
+            kind, value = output[i + 1], output[i + 2]
+
+            if kind == 'cp':
+                try:
+                    return {'cp': int(value)}
+                except ValueError:
+                    return None
+            elif kind == 'mate':
+                if value in ['+', '-']:
+                    return {'mate': 1 if value == '+' else -1}
+                try:
+                    return {'mate': int(value)}
+                except ValueError:
+                    return None
+
+    return None
+
+def resolve_url(ip, port, name):
+    """Ask the server which server to join.
+
+    If the server routes clients to shards, the client joins the shard.
+
+    # Arguments
+        ip: The ip of the server.
+        port: The port of the server.
+        name: The name of the USI engine.
+
+    # Returns
+        The url of the server to join.
+    """
+    url = 'http://{}:{}'.format(ip, port)
+
+    try:
+        response = requests.get(url + '/front/route', params={'name': name}, timeout=10)
+    except requests.RequestException:
+        return url
+
+    if response.status_code != 200:
+        return url
+
+    return 'http://{}:{}'.format(ip, response.json()['port'])
+
+class Engine:
+    """An USI engine and the state of the game it plays.
+    """
+    def __init__(self, slot=None):
+        # Slot of the engine, if the client plays several games over one connection.
+        self.slot = slot
+
+        self.process = None
+        self.queue = queue.Queue()
+
+        # The predicted move of the opponent the engine is pondering on.
+        self.ponder = None
+
+        # The game the engine plays, i.e. the position, the initial position and the moves after it.
+        self.state = minishogilib.Position()
+        self.start = None
+        self.moves = []
+
+        # The engine information sent by `id` command.
+        self.info = { }
+
+        # If true, print messages to and from the engine in stdout.
+        self.verbose = True
+
+def spawn_engine(engine, config):
+    """Run the USI engine, and send `usi` command to it without waiting for `usiok`.
+
+    # Arguments
+        engine: Engine class.
+        config: The client config, i.e. the command and the working directory of the engine.
+    """
+    # Run an USI engine.
+    engine.process = subprocess.Popen(config['command'].split(), cwd=config['cwd'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # Each engine has its own queue, so that outputs of the previous engine never mix in.
+    engine.queue = queue.Queue()
+    engine.ponder = None
+
+    # Run a thread that receives outputs of stdout of the USI engine.
+    threading.Thread(target=message_reader, args=[engine.process.stdout, engine.queue, engine.verbose]).start()
+
+    # Send usi command to the engine.
+    send_message(engine.process, 'usi', engine.verbose)
+
+def read_id(message, engine_info):
+    """Store the engine information of `id` command (e.g. `id name Engine`) in the dictionary.
+    """
+    output = message.split(None, 2)
+    if len(output) == 3:
+        engine_info[output[1]] = output[2]
+
+def set_options(engine, config):
+    """Send the USI options of the client config to the engine.
+    """
+    for option, value in config['option'].items():
+        message = 'setoption name {} value {}'.format(option, value)
+        send_message(engine.process, message, engine.verbose)
+
+def launch_engine(engine, config, timeout=None):
+    """Run the USI engine, and send `usi` command and USI options to it.
+
+    # Arguments
+        engine: Engine class.
+        config: The client config, i.e. the command, the working directory and USI options of the engine.
+        timeout: Seconds to wait for `usiok`. If None, wait forever.
+
+    # Returns
+        The engine information sent by `id` command.
+
+    # Raises
+        EngineTimeout: `usiok` did not arrive within the timeout.
+        EngineError: The USI engine exited.
+    """
+    spawn_engine(engine, config)
+
+    # Get engine information.
+    engine_info = { }
+    wait_for(engine.queue, 'usiok', timeout, {'id': lambda message: read_id(message, engine_info)})
+    engine.info = engine_info
+
+    # Set USI options
+    set_options(engine, config)
+
+    return engine_info
+
+def stop_engine(engine, timeout=None):
+    """Send `quit` command to the USI engine, and kill it if it does not exit in time.
+
+    # Arguments
+        engine: Engine class.
+        timeout: Seconds to wait for the USI engine to exit. If None, wait forever.
+    """
+    try:
+        send_message(engine.process, 'quit', engine.verbose)
+        engine.process.wait(timeout)
+    except (OSError, subprocess.TimeoutExpired):
+        print('ERROR: The USI engine did not quit within {} seconds.'.format(timeout))
+        engine.process.kill()
+
+def position_command(start, moves):
+    """Returns `position` command of the game.
+
+    # Arguments
+        start: The sfen representation of the initial position.
+        moves: The moves after the initial position in sfen representation.
+    """
+    if len(moves) == 0:
+        return 'position sfen ' + start
+
+    return 'position sfen {} moves {}'.format(start, ' '.join(moves))
+
+def go_command(data, ponder=False):
+    """Returns `go` command with the remaining time of the players.
+
+    # Arguments
+        data: The remaining time of the players (i.e. btime, wtime, byoyomi, binc and winc) in milliseconds.
+        ponder: If true, returns `go ponder` command.
+    """
+    go = 'go ponder' if ponder else 'go'
+
+    if data['byoyomi'] > 0:
+        return '{} btime {} wtime {} byoyomi {}'.format(go, data['btime'], data['wtime'], data['byoyomi'])
+    else:
+        return '{} btime {} wtime {} binc {} winc {}'.format(go, data['btime'], data['wtime'], data['binc'], data['winc'])
+
+def get_slot(data):
+    """Returns the slot of the engine the message is sent to, or None if the client has only one engine.
+    """
+    return data.get('slot') if isinstance(data, dict) else None
+
+def usi_message(engine_info):
+    """`usi` message of the engine, with the version of the protocol the client speaks.
+    """
+    return dict(engine_info, protocol=PROTOCOL_VERSION)
+
+def follow_game(engine, data):
+    """Bring the game of the engine up to the position of `nextmove` message.
+
+    Protocol 2 servers send only the last move of the opponent, otherwise the whole game is sent.
+
+    # Returns
+        False if the position differs from the server's, otherwise True.
+    """
+    if 'position' in data:
+        engine.start, engine.moves = split_position(data['position'])
+        engine.state.set_sfen(data['position'])
+    else:
+        if engine.start is None:
+            return False
+
+        if data['move'] is not None:
+            move = engine.state.sfen_to_move(data['move'])
+            engine.state.do_move(move)
+            engine.moves.append(data['move'])
+
+    if 'checksum' in data:
+        return data['ply'] == engine.state.get_ply() and data['checksum'] == position_checksum(engine.state)
+
+    return True
+
+class Worker:
+    """Plays the games of one slot of the client, as a state machine driven by the messages from the server
+    and the outputs of the USI engine.
+
+    Socket.IO handlers only post the messages to the worker, and the worker talks to the USI engine on its own thread.
+    So the handlers never wait for the engine, and `stop`, `ponderhit` and `quit` are sent as soon as the messages arrive.
+
+    The states are:
+        idle: The engine waits for the next message from the server.
+        readying: `isready` was sent for the game, and the worker waits for `readyok`.
+        checking: `isready` was sent to check the engine before the next game (warm mode).
+        thinking: `go` was sent, and the worker waits for `bestmove`.
+        pondering: `go ponder` was sent on the predicted move of the opponent.
+        stopping: `stop` was sent, and the worker waits for the dummy `bestmove`.
+        quitting: `quit` was sent to start the engine again after the game, and the worker waits for the engine to exit.
+        launching: The engine was started again, and the worker waits for `usiok`.
+    While the worker waits for the engine, the messages from the server wait until it answers.
+    """
+    def __init__(self, engine, config, emit, replace, finish, warm=False):
+        """
+        # Arguments
+            engine: Engine class, which is already launched.
+            config: The client config.
+            emit: The function that sends a message of the engine to the server.
+            replace: The function that kills the engine and returns a spare engine, or leaves the server if there is none.
+            finish: The function called after the engine quits for good.
+            warm: If true, the engine is kept alive across games.
+        """
+        self.engine = engine
+        self.config = config
+        self.emit = emit
+        self.replace = replace
+        self.finish = finish
+        self.warm = warm
+
+        # Seconds to wait for the USI engine.
+        self.usi_timeout = config.get('usi_timeout', 60)
+        self.isready_timeout = config.get('isready_timeout', 300)
+        self.timeout_margin = config.get('timeout_margin', 10)
+
+        # Messages from the server and outputs of the engines.
+        self.events = queue.Queue()
+
+        self.state = 'idle'
+
+        # The command the worker waits for, and the deadline in the monotonic clock.
+        self.expected = None
+        self.deadline = None
+
+        # Messages from the server that wait until the engine answers.
+        self.deferred = []
+
+        # The last `nextmove` message, the side to move, the start of the thought,
+        # the last score the engine reported, and whether a spare engine already took over the move.
+        self.data = None
+        self.color = 0
+        self.think_start_time = None
+        self.reported = { }
+        self.retried = False
+
+    def start(self):
+        threading.Thread(target=self.run).start()
+        self.follow(self.engine)
+
+    def post(self, event, data=None):
+        """Post a message from the server to the worker.
+        """
+        self.events.put(('server', event, data))
+
+    def follow(self, engine):
+        """Forward the outputs of the engine to the worker.
+        """
+        # Note: the queue is renewed when the engine is launched again, so outputs are told apart by the queue.
+        outputs = engine.queue
+
+        def forward():
+            while True:
+                message = outputs.get()
+                self.events.put(('engine', outputs, message))
+                if message is None:
+                    break
+
+        threading.Thread(target=forward).start()
+
+    def send(self, message):
+        try:
+            send_message(self.engine.process, message, self.engine.verbose)
+        except OSError:
+            # The engine exited, and the worker is told by the end of its outputs.
+            pass
+
+    def wait(self, command, timeout):
+        """Wait for the command of the engine within the timeout in seconds.
+        """
+        self.expected = command
+        self.deadline = time.monotonic() + timeout
+
+    def settle(self, state):
+        """Change the state to a state in which the worker does not wait for the engine.
+        """
+        self.state = state
+        self.expected = None
+        self.deadline = None
+
+    def run(self):
+        while True:
+            timeout = None if self.deadline is None else max(0, self.deadline - time.monotonic())
+            try:
+                event = self.events.get(timeout=timeout)
+            except Empty:
+                self.fail(EngineTimeout('The USI engine did not send `{}` in time.'.format(self.expected)))
+                continue
+
+            if event[0] == 'server':
+                if event[1] == 'disconnect':
+                    # Quit the engine even while it thinks.
+                    self.quit()
+                    return
+
+                self.receive(event[1], event[2])
+
+            elif event[1] is self.engine.queue:
+                # Note: outputs of the engines that were replaced or quit are discarded.
+                if event[2] is None:
+                    self.fail(EngineError('The USI engine exited.'))
+                else:
+                    self.output(event[2])
+
+    def receive(self, event, data):
+        """A message from the server arrived.
+        """
+        if self.state in ['readying', 'checking', 'stopping', 'quitting', 'launching']:
+            self.deferred.append((event, data))
+            return
+
+        if self.state == 'pondering' and event == 'nextmove':
+            self.nextmove(data)
+            return
+
+        if self.state in ['thinking', 'pondering']:
+            # The game is over (e.g. the opponent lost by time), so stop the search before the next message.
+            self.stop()
+            self.deferred.append((event, data))
+            return
+
+        if event == 'isready':
+            self.send('isready')
+            self.state = 'readying'
+            self.wait('readyok', self.isready_timeout)
+
+        elif event == 'usinewgame':
+            self.send('usinewgame')
+
+            # The whole game is sent with the first `nextmove` message.
+            self.engine.start = None
+            self.engine.moves = []
+
+        elif event == 'nextmove':
+            self.nextmove(data)
+
+        elif event == 'think':
+            # The search on the predicted move stopped, so think on the actual move.
+            self.think(data)
+
+        elif event == 'restart_engine':
+            self.restart()
+
+    def output(self, message):
+        """An output of the engine arrived.
+        """
+        output = message.split()
+        if len(output) == 0:
+            return
+
+        if self.state == 'readying' and output[0] == 'readyok':
+            self.settle('idle')
+            self.emit(self.engine, 'readyok')
+
+        elif self.state == 'checking' and output[0] == 'readyok':
+            self.settle('idle')
+            self.emit(self.engine, 'usi', usi_message(self.engine.info))
+
+        elif self.state == 'launching' and output[0] == 'id':
+            read_id(message, self.engine.info)
+
+        elif self.state == 'launching' and output[0] == 'usiok':
+            set_options(self.engine, self.config)
+            self.settle('idle')
+            self.emit(self.engine, 'usi', usi_message(self.engine.info))
+
+        elif self.state == 'thinking' and output[0] == 'info':
+            score = parse_score(message)
+            if score is not None:
+                self.reported['score'] = score
+
+        elif self.state == 'thinking' and output[0] == 'bestmove':
+            self.bestmove(output)
+
+        elif self.state in ['pondering', 'stopping'] and output[0] == 'bestmove':
+            # Note: this `bestmove` command is dummy, because the predicted ponder move is different from the actual given move.
+            self.engine.ponder = None
+            self.settle('idle')
+
+        self.resume()
+
+    def resume(self):
+        """Handle the messages from the server that waited for the engine.
+        """
+        while len(self.deferred) > 0 and self.state == 'idle':
+            event, data = self.deferred.pop(0)
+            self.receive(event, data)
+
+    def stop(self):
+        self.send('stop')
+        self.engine.ponder = None
+        self.state = 'stopping'
+        self.wait('bestmove', self.timeout_margin)
+
+    def bestmove_timeout(self, data, color):
+        """Seconds to wait for `bestmove` command, i.e. the remaining time of the player and a margin.
+        """
+        remaining = data['btime'] if color == 0 else data['wtime']
+        inc = data['binc'] if color == 0 else data['winc']
+        return (remaining + data['byoyomi'] + inc) / 1000 + self.timeout_margin
+
+    def nextmove(self, data):
+        """`nextmove` message was sent from the server.
+
+        The client has to ask the engine a next move.
+        """
+        if not follow_game(self.engine, data):
+            # Ask the whole game, and wait for another `nextmove` message.
+            self.engine.start = None
+            if self.state == 'pondering':
+                self.stop()
+            self.emit(self.engine, 'resync')
+            return
+
+        if self.state == 'pondering':
+            # If ponder is set, judge whether the ponder move is the same as the actual move.
+            if len(self.engine.moves) > 0 and self.engine.ponder == self.engine.moves[-1]:
+                # If ponder is the same, send `ponderhit` command to the USI engine.
+                self.send('ponderhit')
+                self.begin(data)
+            else:
+                # If ponder is not the same, stop the search, and think after the dummy `bestmove`.
+                self.stop()
+                self.deferred.insert(0, ('think', data))
+            return
+
+        self.think(data)
+
+    def think(self, data):
+        """Ask the USI engine a next move.
+        """
+        self.send(position_command(self.engine.start, self.engine.moves))
+        self.send(go_command(data))
+        self.begin(data)
+
+    def begin(self, data):
+        """The engine started to think on the move of `nextmove` message.
+        """
+        self.data = data
+        self.color = self.engine.state.get_side_to_move()
+        self.think_start_time = time.monotonic_ns()
+        self.reported = { }
+        self.retried = False
+
+        self.state = 'thinking'
+        self.wait('bestmove', self.bestmove_timeout(data, self.color))
+
+    def bestmove(self, output):
+        """The engine sent `bestmove` command.
+        """
+        data = self.data
+        engine = self.engine
+
+        # Report the time the engine thought, so that the server does not charge the lag.
+        think_elapsed = (time.monotonic_ns() - self.think_start_time) // 1000000
+
+        bestmove = {'move': output[1], 'think': think_elapsed}
+        if 'score' in self.reported:
+            bestmove['score'] = self.reported['score']
+        self.emit(engine, 'bestmove', bestmove)
+
+        # Calculate the remaining time while pondering.
+        if self.color == 0:
+            data['btime'] -= think_elapsed
+        else:
+            data['wtime'] -= think_elapsed
+
+        if len(output) >= 4 and output[2] == 'ponder':
+            # If ponder is sent, set ponder move and send `go ponder` command to the USI engine.
+            engine.ponder = output[3]
+            ponder_position = position_command(engine.start, engine.moves + [output[1], engine.ponder])
+
+            self.send(ponder_position)
+            self.send(go_command(data, ponder=True))
+            self.settle('pondering')
+        else:
+            engine.ponder = None
+            self.settle('idle')
+
+        # The server sends only the move of the opponent next time, so keep the own move.
+        # Note: the game ends if the move is illegal, so the game is not kept.
+        if output[1] not in [m.sfen() for m in engine.state.generate_moves()]:
+            engine.start = None
+            return
+
+        engine.state.do_move(engine.state.sfen_to_move(output[1]))
+        engine.moves.append(output[1])
+
+    def restart(self):
+        """`restart_engine` message was sent from the server, i.e. the game is over.
+        """
+        if self.warm:
+            # Keep the USI engine for the next game if it still answers `isready`.
+            self.send('isready')
+            self.state = 'checking'
+            self.wait('readyok', self.isready_timeout)
+            return
+
+        # Quit the USI engine, and start it again after its outputs end.
+        self.send('quit')
+        self.state = 'quitting'
+        self.wait(None, self.usi_timeout)
+
+    def launch(self):
+        """Start the USI engine again, and wait for `usiok`.
+        """
+        try:
+            spawn_engine(self.engine, self.config)
+        except OSError as error:
+            self.abort(EngineError('The USI engine could not start: {}'.format(error)))
+            return
+
+        self.engine.info = { }
+        self.follow(self.engine)
+
+        self.state = 'launching'
+        self.wait('usiok', self.usi_timeout)
+
+    def fail(self, error):
+        """The USI engine is wedged or exited, so a spare engine takes over.
+        """
+        if self.state == 'quitting':
+            # The engine exited, or it did not quit in time and is killed, so start it again.
+            if isinstance(error, EngineTimeout):
+                print('ERROR: The USI engine did not quit within {} seconds.'.format(self.usi_timeout))
+                self.engine.process.kill()
+            self.launch()
+            return
+
+        if self.state == 'launching' or (self.state == 'thinking' and self.retried):
+            # The engine could not start again, or the spare engine failed too.
+            self.abort(error)
+            return
+
+        state = self.state
+        self.engine = self.replace(self.engine, error)
+        self.follow(self.engine)
+
+        if state == 'readying':
+            # A spare engine is already ready.
+            self.settle('idle')
+            self.emit(self.engine, 'readyok')
+
+        elif state == 'checking':
+            self.settle('idle')
+            self.emit(self.engine, 'usi', usi_message(self.engine.info))
+
+        elif state == 'thinking':
+            # Ask the spare engine the move instead.
+            self.send(position_command(self.engine.start, self.engine.moves))
+            self.send(go_command(self.data))
+            self.reported = { }
+            self.retried = True
+            self.wait('bestmove', self.bestmove_timeout(self.data, self.color))
+
+        else:
+            self.settle('idle')
+
+        self.resume()
+
+    def abort(self, error):
+        """The USI engine is wedged or exited, so kill it and leave the server.
+        """
+        print('ERROR: {}'.format(error))
+        self.engine.process.kill()
+        os._exit(1)
+
+    def quit(self):
+        stop_engine(self.engine, self.usi_timeout)
+        self.finish(self)
+
+def main(ip, port, config_json, concurrency=1, warm=False, spare_count=1):
     with open(config_json) as f:
         config = json.load(f)
 
-    state = minishogilib.Position()
+    # Seconds to wait for the USI engine.
+    usi_timeout = config.get('usi_timeout', 60)
+    isready_timeout = config.get('isready_timeout', 300)
 
-    usi_engine = None
-    message_queue = queue.Queue()
+    # USI engines for each slot.
+    if concurrency > 1:
+        engines = {slot: Engine(slot) for slot in range(concurrency)}
+    else:
+        engines = {None: Engine()}
 
-    def start_engine():
-        # Run an USI engine.
-        nonlocal usi_engine
-        usi_engine = subprocess.Popen(config['command'].split(), cwd=config['cwd'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    # Workers that play the games of each slot.
+    workers = { }
+    workers_lock = threading.Lock()
 
-        # Run a thread that receives outputs of stdout of the USI engine.
-        threading.Thread(target=message_reader, args=[usi_engine.stdout, message_queue]).start()
+    # Spare USI engines that already sent `readyok`, used in warm mode.
+    spares = queue.Queue()
 
-        # Send usi command to the engine.
-        send_message(usi_engine, 'usi')
+    def abort(engine, error):
+        """The USI engine is wedged or exited, so kill it and leave the server.
+        """
+        print('ERROR: {}'.format(error))
+        engine.process.kill()
+        os._exit(1)
 
-        # Get engine information.
-        engine_info = { }
-        while True:
-            output = receive_message(message_queue).split(None, 2)
+    def quit_engine(engine):
+        stop_engine(engine, usi_timeout)
 
-            if len(output) == 0:
-                continue
+    def quit_spares():
+        while not spares.empty():
+            quit_engine(spares.get())
+
+    def finish_worker(worker):
+        """The engine of the worker quit, so quit this client if no engine is left.
+        """
+        with workers_lock:
+            workers.pop(worker.engine.slot, None)
+            if len(workers) == 0:
+                quit_spares()
+                os._exit(0)
+
+    def start_engine(engine):
+        try:
+            return launch_engine(engine, config, usi_timeout)
+        except EngineError as error:
+            abort(engine, error)
+
+    def prepare_spare():
+        """Start a spare USI engine, and wait until it gets ready.
+
+        # Raises
+            EngineError: The USI engine did not get ready.
+        """
+        spare = Engine()
+        launch_engine(spare, config, usi_timeout)
 
-            if output[0] == 'id':
-                engine_info[output[1]] = output[2]
+        send_message(spare.process, 'isready')
+        try:
+            wait_for(spare.queue, 'readyok', isready_timeout)
+        except EngineError:
+            spare.process.kill()
+            raise
 
-            if output[0] == 'usiok':
-                break
+        return spare
 
-        # Set USI options
-        for option, value in config['option'].items():
-            message = 'setoption name {} value {}'.format(option, value)
-            send_message(usi_engine, message)
+    def add_spare():
+        try:
+            spares.put(prepare_spare())
+        except EngineError as error:
+            print('ERROR: A spare engine could not start: {}'.format(error))
 
-        sio.emit('usi', engine_info, namespace='/match')
+    def replace_engine(engine, error):
+        """The USI engine is wedged or exited, so kill it and play with a spare engine instead.
+
+        Without warm mode, leave the server.
+
+        # Returns
+            The spare engine, which takes over the slot of the engine.
+        """
+        if not warm:
+            abort(engine, error)
+
+        print('ERROR: {}'.format(error))
+        engine.process.kill()
+
+        try:
+            spare = spares.get(timeout=isready_timeout) if spare_count > 0 else prepare_spare()
+        except (Empty, EngineError) as error:
+            abort(engine, 'No spare engine is ready: {}'.format(error))
+
+        # Refill the pool in background.
+        if spare_count > 0:
+            threading.Thread(target=add_spare).start()
+
+        # The spare engine takes over the game as well.
+        spare.slot = engine.slot
+        spare.state, spare.start, spare.moves = engine.state, engine.start, engine.moves
+
+        return spare
+
+    def emit(engine, event, data=None):
+        """Send a message to the server.
+
+        If the client plays several games over one connection, the message is tagged with the slot of the engine.
+        """
+        if engine.slot is not None:
+            data = dict(data or { }, slot=engine.slot)
+
+        sio.emit(event, data, namespace='/match')
+
+    def post(event, data=None):
+        """Post the message from the server to the worker of the slot.
+        """
+        with workers_lock:
+            worker = workers.get(get_slot(data))
+
+        if worker is not None:
+            worker.post(event, data)
 
     # #########################################################################################
     # Socket-IO Events BEGIN
     # #########################################################################################
+    # Note: the handlers only post the messages to the workers, and never wait for the USI engines.
     sio = socketio.Client()
 
     @sio.event(namespace='/match')
     def restart_engine(data=None):
-        # Quit the USI engine
-        send_message(usi_engine, 'quit')
-        usi_engine.wait()
-
-        # Initialize
-        with message_queue.mutex:
-            message_queue.queue.clear()
-        nextmove.ponder = None
-
-        # Start the USI engine
-        start_engine()
+        """`restart_engine` message was sent from the server, i.e. the game is over.
+        """
+        post('restart_engine', data)
 
     @sio.on('error', namespace='/match')
     def error(message):
         """An error message was sent from the server.
         """
-        print('ERROR: {}'.format(message))
-        os._exit(0)
+        if isinstance(message, dict):
+            print('ERROR: {}'.format(message['message']))
+            post('disconnect', message)
+        else:
+            print('ERROR: {}'.format(message))
+            os._exit(0)
 
     @sio.on('info', namespace='/match')
     def info(message):
         """An information message was sent from the server.
         """
-        print('INFO: {}'.format(message))
+        print('INFO: {}'.format(message['message'] if isinstance(message, dict) else message))
+
+    @sio.on('clock', namespace='/match')
+    def clock(data):
+        """`clock` message was sent from the server to measure the round trip time.
+        """
+        sio.emit('clock', data, namespace='/match')
 
     @sio.on('isready', namespace='/match')
     def isready(data=None):
         """`isready` message was sent from the server.
 
         If a client gets this message, the client has to send `isready` command to the USI engine,
-        and waits until `readyok` command is sent.
+        and sends `readyok` message when `readyok` command is sent.
         """
-        send_message(usi_engine, 'isready')
-
-        while True:
-            output = receive_message(message_queue).split()
-
-            if len(output) == 0:
-                continue
-
-            if output[0] == 'readyok':
-                break
-
-        # Send `readyok` message to the server.
-        sio.emit('readyok', namespace='/match')
+        post('isready', data)
 
     @sio.on('usinewgame', namespace='/match')
     def usinewgame(data=None):
@@ -156,7 +906,7 @@ def main(ip, port, config_json):
 
         If a client gets this message, the client has to send `usinewgame` command to the USI engine.
         """
-        send_message(usi_engine, 'usinewgame')
+        post('usinewgame', data)
 
     @sio.on('nextmove', namespace='/match')
     def nextmove(data):
@@ -164,101 +914,52 @@ def main(ip, port, config_json):
 
         If a client gets this message, the client has to ask the engine a next move.
         """
-        if nextmove.ponder is not None:
-            # If ponder is set, judge whether the ponder move is the same as the actual move.
-            if nextmove.ponder == data['position'].split()[-1]:
-                # If ponder is the same, send `ponderhit` command to the USI engine.
-                send_message(usi_engine, 'ponderhit')
-            else:
-                # If ponder is not the same, send `stop` command to the USI engine.
-                send_message(usi_engine, 'stop')
-                nextmove.ponder = None
-
-                # Wait until `bestmove` command is sent.
-                # Note: this `bestmove` command is dummy, because the predicted ponder move is different from the actual given move.
-                while True:
-                    output = receive_message(message_queue).split()
-
-                    if len(output) == 0:
-                        continue
-
-                    if output[0] == 'bestmove':
-                        break
-
-        # Sfen representation of the current position.
-        sfen_position = 'position sfen ' + data['position']
-        
-        # Start the timer
-        think_start_time = time.time_ns()
-
-        if nextmove.ponder is None:
-            # Ask the USI engine a next move.
-            send_message(usi_engine, sfen_position)
-
-            if data['byoyomi'] > 0:
-                command = 'go btime {} wtime {} byoyomi {}'.format(data['btime'], data['wtime'], data['byoyomi'])
-            else:
-                command = 'go btime {} wtime {} binc {} winc {}'.format(data['btime'], data['wtime'], data['binc'], data['winc'])
-            send_message(usi_engine, command)
-
-        # Wait until `bestmove` command is sent.
-        while True:
-            output = receive_message(message_queue).split()
-
-            if len(output) == 0:
-                continue
-
-            if output[0] == 'bestmove':
-                sio.emit('bestmove', output[1], namespace='/match')
-                
-                # Calculate the remaining time while pondering.
-                think_elapsed = (time.time_ns() - think_start_time) // 1000000
-                state.set_sfen(data['position'])
-                if state.get_side_to_move() == 0:
-                    data['btime'] -= think_elapsed
-                else:
-                    data['wtime'] -= think_elapsed
-
-                if len(output) >= 4 and output[2] == 'ponder':
-                    # If ponder is sent, set ponder move and send `go ponder` command to the USI engine.
-                    nextmove.ponder = output[3]
-                    if sfen_position[-1] == '1' :
-                        # If the position is the initial position, `moves` should be added.
-                        ponder_position = '{} moves {} {}'.format(sfen_position, output[1], nextmove.ponder)
-                    else:
-                        ponder_position = '{} {} {}'.format(sfen_position, output[1], nextmove.ponder)
-
-                    send_message(usi_engine, ponder_position)                    
-                    if data['byoyomi'] > 0:
-                        command = 'go ponder btime {} wtime {} byoyomi {}'.format(data['btime'], data['wtime'], data['byoyomi'])
-                    else:
-                        command = 'go ponder btime {} wtime {} binc {} winc {}'.format(data['btime'], data['wtime'], data['binc'], data['winc'])
-                    send_message(usi_engine, command)
-                else:
-                    nextmove.ponder = None
-
-                break
-
-    # Set ponder move to be None at initialization.
-    nextmove.ponder = None
+        post('nextmove', data)
 
     @sio.event(namespace='/match')
     def disconnect(data=None):
         """Disconnect from the matching server.
 
-        After disconnection, quit the USI engine and this client.
+        After disconnection, quit the USI engines and this client.
+        If the server sends `disconnect` message to one of the engines, quit only the engine.
         """
-        send_message(usi_engine, 'quit')
-        usi_engine.wait()
-        os._exit(0)
+        if isinstance(data, dict):
+            post('disconnect', data)
+            return
+
+        with workers_lock:
+            targets = list(workers.values())
+
+        for worker in targets:
+            worker.post('disconnect')
 
     # #########################################################################################
     # Socket-IO Events END
     # #########################################################################################
 
-    url = 'http://{}:{}'.format(ip, port)
-    sio.connect(url)
-    start_engine()
+    # Start all the USI engines at once.
+    engine_infos = { }
+
+    def start(engine):
+        engine_infos[engine.slot] = start_engine(engine)
+
+    threads = [threading.Thread(target=start, args=[engine]) for engine in engines.values()]
+    if warm:
+        threads += [threading.Thread(target=add_spare) for _ in range(spare_count)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for engine in engines.values():
+        workers[engine.slot] = Worker(engine, config, emit, replace_engine, finish_worker, warm)
+        workers[engine.slot].start()
+
+    name = next(iter(engine_infos.values())).get('name', '')
+    sio.connect(resolve_url(ip, port, name))
+    for engine in engines.values():
+        emit(engine, 'usi', usi_message(engine_infos[engine.slot]))
     sio.wait()
 
 if __name__ == '__main__':
@@ -266,7 +967,11 @@ if __name__ == '__main__':
     parser.add_option('-c', '--config', dest='config_json', help='confile json file', default='./client.json')
     parser.add_option('-i', '--ip', dest='ip', help='target ip', default='localhost')
     parser.add_option('-p', '--port', dest='port', help='target port', type='int', default=8000)
+    parser.add_option('-n', '--concurrency', dest='concurrency', help='the number of games played at once', type='int', default=1)
+    parser.add_option('--warm', dest='warm', action='store_true', help='keep the engines alive across games', default=False)
+    parser.add_option('--spares', dest='spare_count', help='the number of spare engines in warm mode', type='int', default=1)
 
     (options, args) = parser.parse_args()
 
-    main(ip=options.ip, port=options.port, config_json=options.config_json)
+    main(ip=options.ip, port=options.port, config_json=options.config_json, concurrency=options.concurrency,
+         warm=options.warm, spare_count=options.spare_count)
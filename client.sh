@@ -6,10 +6,8 @@
 #%    Execute multiple pairs of clients
 #%
 #%    [pair_count]     the number of pairs of clients will be executed
+#%
+#%    Each player runs all of its engines in one client process over one connection.
 
-for ((i=0;i<$1;i++)); do
-    python3.7 client.py --config client1.json > /dev/null &
-    sleep 0.3
-    python3.7 client.py --config client2.json > /dev/null &
-    sleep 0.3
-done
\ No newline at end of file
+python3.7 client.py --config client1.json --concurrency $1 > /dev/null &
+python3.7 client.py --config client2.json --concurrency $1 > /dev/null &
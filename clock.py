@@ -0,0 +1,67 @@
+import time
+
+
+def now_ms():
+    """Returns the time of the monotonic clock in milliseconds.
+
+    The monotonic clock never jumps, even if the system time is adjusted.
+    """
+    return time.monotonic_ns() // 1000000
+
+class RoundTripTimes:
+    """Round trip times between the server and each client, measured by `clock` messages.
+    """
+    def __init__(self, smoothing=0.25):
+        # The smoothed round trip time of each sid in milliseconds.
+        self.rtt = { }
+
+        # The weight of a new sample.
+        self.smoothing = smoothing
+
+    def sample(self, sid, sent):
+        """Record a `clock` message that came back from the client.
+
+        # Arguments
+            sid: The sid of the client.
+            sent: The time the server sent the message in milliseconds.
+        """
+        rtt = max(0, now_ms() - sent)
+
+        if sid in self.rtt:
+            self.rtt[sid] += self.smoothing * (rtt - self.rtt[sid])
+        else:
+            self.rtt[sid] = rtt
+
+    def get(self, sid):
+        return self.rtt.get(sid)
+
+    def forget(self, sid):
+        self.rtt.pop(sid, None)
+
+def compensate(raw, think, rtt, max_lag, margin=100):
+    """Returns the time charged to the player for a move.
+
+    The time the server measured includes the network and the queueing in the server.
+    The lag, which is the time the client was not thinking, is not charged up to max_lag.
+    The time the client reports is not trusted, so the lag is at most the round trip time and the margin.
+
+    # Arguments
+        raw: The time from the server asking the move to the move arriving in milliseconds.
+        think: The time the client reported the engine thought in milliseconds, or None.
+            Values that are not non-negative numbers are ignored.
+        rtt: The round trip time to the client in milliseconds, or None if unknown.
+        max_lag: The maximum allowance of the lag in milliseconds.
+        margin: The allowance of the lag beyond the round trip time in milliseconds, e.g. for the queueing in the server.
+    """
+    if isinstance(think, bool) or not isinstance(think, (int, float)) or not think >= 0:
+        think = None
+
+    if think is not None:
+        lag = raw - min(think, raw)
+        lag = min(lag, margin if rtt is None else rtt + margin)
+    elif rtt is not None:
+        lag = rtt
+    else:
+        lag = 0
+
+    return raw - min(lag, max_lag)
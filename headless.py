@@ -0,0 +1,246 @@
+from archive import Archive
+from client import Engine, EngineError, EngineTimeout, go_command, launch_engine, parse_score, send_message, stop_engine, wait_for
+from openings import load_openings
+from optparse import OptionParser
+import os
+from server import Client, Game, PLAYER_STR, Tournament, initial_position, load_tournaments
+import simplejson as json
+import threading
+import time
+
+
+class Player:
+    """An USI engine driven over pipes, and its config.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.engine = Engine()
+        self.engine.verbose = False
+
+        # Seconds to wait for the USI engine.
+        self.usi_timeout = config.get('usi_timeout', 60)
+        self.isready_timeout = config.get('isready_timeout', 300)
+        self.timeout_margin = config.get('timeout_margin', 10)
+
+        self.client = Client()
+
+    def start(self):
+        engine_info = launch_engine(self.engine, self.config, self.usi_timeout)
+        self.client.name = engine_info.get('name', '')
+
+    def is_alive(self):
+        return self.engine.process.poll() is None
+
+    def kill(self):
+        self.engine.process.kill()
+        self.engine.process.wait()
+
+    def quit(self):
+        stop_engine(self.engine, self.usi_timeout)
+
+    def send(self, message):
+        send_message(self.engine.process, message, self.engine.verbose)
+
+    def newgame(self):
+        """Send `isready` and `usinewgame` commands, so that the engine reuses its process for the next game.
+        """
+        self.send('isready')
+        wait_for(self.engine.queue, 'readyok', self.isready_timeout)
+        self.send('usinewgame')
+
+    def bestmove(self, game, color):
+        """Ask the USI engine a next move.
+
+        # Arguments
+            game: Game class.
+            color: The side to move (0=First player, 1=Second player).
+
+        # Returns
+            The sfen representation of the move, the time the engine consumed in milliseconds,
+            and the last score the engine reported (or None).
+            The move is None if the engine did not answer in time.
+        """
+        data = game.time_control()
+
+        # Seconds to wait for `bestmove` command, i.e. the remaining time of the player and a margin.
+        timeout = (game.timelimit[color] + game.byoyomi + game.inc[color]) / 1000 + self.timeout_margin
+
+        self.send('position sfen ' + game.position.sfen(True))
+        self.send(go_command(data))
+
+        start_time = time.monotonic()
+
+        # The last score the engine reported while thinking.
+        reported = { }
+
+        def info(message):
+            score = parse_score(message)
+            if score is not None:
+                reported['score'] = score
+
+        try:
+            output = wait_for(self.engine.queue, 'bestmove', timeout, {'info': info})
+        except EngineTimeout:
+            output = None
+
+        elapsed = (time.monotonic() - start_time) * 1000
+
+        if output is None or len(output) < 2:
+            return None, elapsed, None
+
+        return output[1], elapsed, reported.get('score')
+
+def play(game, players):
+    """Play the game between the USI engines to the end.
+
+    # Arguments
+        game: Game class.
+        players: The players of the game (0=First player, 1=Second player).
+
+    # Returns
+        The winner of the game (0=First player, 1=Second player), or DRAW.
+
+    # Raises
+        EngineError: The USI engine exited.
+    """
+    for player in players:
+        player.newgame()
+
+    game.ongoing = True
+
+    while True:
+        color = game.position.get_side_to_move()
+
+        sfen_move, elapsed, score = players[color].bestmove(game, color)
+
+        if sfen_move is None:
+            # The engine did not answer in time, so it is wedged. Kill it, and start a new one for the next game.
+            game.gameover = PLAYER_STR[color] + '_TIME_UP'
+            players[color].kill()
+            return int(not color)
+
+        winner = game.apply_move(color, sfen_move, elapsed, score=score)
+        if winner is not None:
+            return winner
+
+def main(config_json, engine_jsons, concurrency):
+    with open(config_json) as f:
+        config = json.load(f)
+
+    engine_configs = []
+    for engine_json in engine_jsons:
+        with open(engine_json) as f:
+            engine_configs.append(json.load(f))
+
+    if 'tournament' not in config:
+        print('ERROR: The headless runner plays tournaments only, so set `tournament` in the server config.')
+        return
+
+    # Every game is played by its own pair of USI engines.
+    concurrency = max(1, min(concurrency, config['tournament']))
+    pairs = [[Player(engine_config) for engine_config in engine_configs] for _ in range(concurrency)]
+
+    # Start all the USI engines at once.
+    errors = []
+
+    def start(player):
+        try:
+            player.start()
+        except EngineError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=start, args=[player]) for pair in pairs for player in pair]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        print('ERROR: {}'.format(errors[0]))
+        for pair in pairs:
+            for player in pair:
+                if player.engine.process is not None:
+                    player.kill()
+        return
+
+    archive = Archive(**config.get('archive', { }))
+    openings = load_openings(config)
+
+    names = [pairs[0][0].client.name, pairs[0][1].client.name]
+
+    # Resume the tournament of the engines if the runner stopped halfway.
+    tournament = next((t for t in load_tournaments(config.get('sprt')) if sorted(t.names) == sorted(names)), None)
+    if tournament is None:
+        tournament = Tournament(config['tournament'], config.get('sprt'))
+        tournament.names = names
+
+    # The tournament and the tournament file are shared by the workers.
+    lock = threading.Lock()
+
+    def worker(pair):
+        while True:
+            with lock:
+                index, first = tournament.claim(pair[0].client.name, config['swap_turn'])
+                if index is None:
+                    break
+
+                game = Game(position=initial_position(openings, config['swap_turn'], index))
+                game.setConfig(config)
+                game.index = index
+                game.tournament = tournament
+                tournament.games[index] = game
+
+            players = pair if first else pair[::-1]
+            game.clients = [player.client for player in players]
+
+            print('INFO: Create new game: index=', index, game.clients[0].name, 'vs', game.clients[1].name)
+
+            try:
+                winner = play(game, players)
+            except EngineError as error:
+                # Abandon the game, so that it will be played again with new engines.
+                print('ERROR: {}'.format(error))
+                with lock:
+                    tournament.release(index)
+                for player in pair:
+                    player.kill()
+            else:
+                with lock:
+                    game.ongoing = False
+                    tournament.gameover(game, winner)
+                    archive.add(game)
+
+                    if tournament.is_finished():
+                        tournament.dump()
+                        print('INFO: Tournament finished')
+
+            try:
+                # Start new engines in place of the engines that exited or were killed.
+                for player in pair:
+                    if not player.is_alive():
+                        player.start()
+            except EngineError as error:
+                print('ERROR: {}'.format(error))
+                break
+
+        for player in pair:
+            player.quit()
+
+    threads = [threading.Thread(target=worker, args=[pair]) for pair in pairs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    archive.close()
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-c', '--config', dest='config_json', help='server config json file', default='./server.json')
+    parser.add_option('--engine1', dest='engine1_json', help='client config json file of the first engine', default='./client1.json')
+    parser.add_option('--engine2', dest='engine2_json', help='client config json file of the second engine', default='./client2.json')
+    parser.add_option('-n', '--concurrency', dest='concurrency', help='the number of games played at once', type='int', default=os.cpu_count())
+
+    (options, args) = parser.parse_args()
+
+    main(config_json=options.config_json, engine_jsons=[options.engine1_json, options.engine2_json], concurrency=options.concurrency)
@@ -1,7 +1,8 @@
 var url = window.location.protocol + "//" + window.location.host + "/";
 var id = window.location.search.slice(1);
 
-var socket = io(url);
+// Ask the board in sfen representation, and render it here instead of receiving SVG.
+var socket = io(url, {query: "compact=1"});
 
 var timelimit = null;
 var side_to_move = 0;
@@ -10,19 +11,119 @@ var ongoing = false;
 var gameover = false;
 
 socket.on("display", function(data) {
-    document.getElementById("board").innerHTML = data["svg"];
-
     var record = document.getElementById("record");
     record.innerHTML = "";
 
-    var ply = 0;
     data["kif"].forEach(function(item, index) {
         var option = document.createElement("option");
         option.text = item;
         record.add(option);
-        ply++;
     });
 
+    update_state(data);
+});
+
+socket.on("display_update", function(data) {
+    var record = document.getElementById("record");
+
+    // Only the last move is sent, so append it if it is new.
+    if (data["move"] != null && record.length < data["ply"]) {
+        var option = document.createElement("option");
+        option.text = data["move"];
+        record.add(option);
+    }
+
+    update_state(data);
+});
+
+var PIECE_KANJI = {
+    "K": "玉", "G": "金", "S": "銀", "B": "角", "R": "飛", "P": "歩",
+    "+S": "全", "+B": "馬", "+R": "龍", "+P": "と"
+};
+var COUNT_KANJI = ["", "", "二", "三", "四"];
+
+var piece_text = function(x, y, size, text, rotate) {
+    return "<text x=\"" + x + "\" y=\"" + y + "\" font-family=\"serif\" font-size=\"" + size + "\" text-anchor=\"middle\" dominant-baseline=\"central\""
+        + (rotate ? " transform=\"rotate(180, " + x + ", " + y + ")\"" : "") + ">" + text + "</text>";
+};
+
+var hand_text = function(x, y, text, rotate) {
+    return "<text x=\"" + x + "\" y=\"" + y + "\" font-family=\"serif\" font-size=\"36\" writing-mode=\"tb\" letter-spacing=\"1\""
+        + (rotate ? " transform=\"rotate(180, " + x + ", " + y + ")\"" : "") + ">" + text + "</text>";
+};
+
+// Render the board of the sfen representation in SVG, in the same layout as the server used to send.
+// The destination square of the last move (in CSA representation) is highlighted.
+var render_board = function(sfen, move) {
+    var fields = sfen.split(" ");
+    var svg = "<svg width=\"448px\" height=\"384px\" xmlns=\"http://www.w3.org/2000/svg\">";
+    svg += "<rect x=\"64\" y=\"32\" width=\"320\" height=\"320\" fill=\"white\" stroke=\"black\" stroke-width=\"3\" />";
+
+    var last = null;
+    if (move != null)
+        last = [parseInt(move[2]), parseInt(move[3])];
+
+    for (var rank = 1; rank <= 5; rank++) {
+        for (var file = 5; file >= 1; file--) {
+            var fill = (last != null && last[0] == file && last[1] == rank) ? "#ffe4b5" : "white";
+            svg += "<rect x=\"" + (64 + (5 - file) * 64) + "\" y=\"" + (32 + (rank - 1) * 64) + "\" width=\"64\" height=\"64\" fill=\"" + fill + "\" stroke=\"black\" stroke-width=\"1\" />";
+        }
+    }
+
+    // Pieces on the board.
+    fields[0].split("/").forEach(function(row, rank) {
+        var column = 0;
+        var promoted = false;
+
+        for (var i = 0; i < row.length; i++) {
+            var c = row[i];
+            if (c == "+") {
+                promoted = true;
+            } else if (c >= "0" && c <= "9") {
+                column += parseInt(c);
+            } else {
+                var kanji = PIECE_KANJI[(promoted ? "+" : "") + c.toUpperCase()];
+                var gote = c != c.toUpperCase();
+                svg += piece_text(96 + column * 64, 64 + rank * 64, 42, kanji, gote);
+
+                column += 1;
+                promoted = false;
+            }
+        }
+    });
+
+    // Pieces in hand, e.g. `1g2S2P`.
+    var hands = ["", ""];
+    if (fields[2] != "-") {
+        var count = "";
+        for (var i = 0; i < fields[2].length; i++) {
+            var c = fields[2][i];
+            if (c >= "0" && c <= "9") {
+                count += c;
+            } else {
+                var n = count == "" ? 1 : parseInt(count);
+                hands[c == c.toUpperCase() ? 0 : 1] += PIECE_KANJI[c.toUpperCase()] + COUNT_KANJI[n];
+                count = "";
+            }
+        }
+    }
+
+    svg += "<text x=\"420\" y=\"32\" font-family=\"serif\" font-size=\"36\" writing-mode=\"tb\">&#9751;</text>";
+    svg += hand_text(420, 74, hands[0], false);
+    svg += "<text x=\"32\" y=\"352\" font-family=\"serif\" font-size=\"36\" writing-mode=\"tb\" transform=\"rotate(180, 32, 352)\">&#9750;</text>";
+    svg += hand_text(32, 310, hands[1], true);
+
+    return svg + "</svg>";
+};
+
+var update_state = function(data) {
+    var record = document.getElementById("record");
+    var last_move = record.length > 0 ? record.options[record.length - 1].text : null;
+
+    // Older servers send the board in SVG.
+    document.getElementById("board").innerHTML = data["svg"] ? data["svg"] : render_board(data["sfen"], last_move);
+
+    var ply = record.length;
     record.scrollTop = record.scrollHeight * Math.max(ply - 1, 0) / ply;
 
     timelimit = data["timelimit"];
@@ -48,7 +149,7 @@ socket.on("display", function(data) {
     document.getElementById("btime").innerHTML = "先手残り " + timelimit["btime"] / 1000 + " 秒 秒読み " + timelimit["byoyomi"] / 1000 + " 秒";
     document.getElementById("wtime").innerHTML = "後手残り " + timelimit["wtime"] / 1000 + " 秒 秒読み " + timelimit["byoyomi"] / 1000 + " 秒";
     document.getElementById("info").innerHTML = gameover;
-});
+};
 
 var display = function() {
     if (timelimit != null) {
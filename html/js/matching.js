@@ -2,39 +2,119 @@ var get_matching = function() {
     var url = window.location.protocol + "//" + window.location.host + "/";
     var socket = io(url);
 
-    socket.emit("matching", function (data) {
-        var pending = document.getElementById("pending");
-        var ongoing = document.getElementById("ongoing");
-        var finished = document.getElementById("finished");
-
-        data.forEach(function(element) {
-            var target = null;
-
-            if (element["ongoing"] == true) {
-                target = document.getElementById("ongoing");
-            } else {
-                if (element["gameover"] == "") {
-                    target = document.getElementById("pending");
-                } else {
-                    target = document.getElementById("finished");
-                }
+    var statuses = ["pending", "ongoing", "finished", "tournament"];
+
+    // The version of the lobby the lists show, or null if changes are not sent (e.g. by the front server of shards).
+    var version = null;
+
+    // The cursors of the next pages.
+    var cursors = { };
+
+    var game_item = function(element) {
+        // The game is hosted by a shard if the port is specified.
+        var link = element["link"];
+        if (element["port"])
+            link = window.location.protocol + "//" + window.location.hostname + ":" + element["port"] + link.slice(1);
+
+        var list = document.createElement("li");
+        list.id = "game-" + element["id"];
+        list.innerHTML = "<a href=" + link + ">" + element["player1"] + " - " + element["player2"] + "</a>";
+        if (element["gameover"])
+            list.innerHTML += " [" + element["gameover"] + "]";
+        return list;
+    };
+
+    var tournament_item = function(element) {
+        var list = document.createElement("li");
+        list.id = "tournament-" + element["id"];
+        list.innerHTML = "<a style='white-space: pre;'>" + element["player1"] + " vs. " + element["player2"] + "<br>"
+                            + "win " + element["player1_win"] + " : " + element["player2_win"] + " (draw " + element["draw"] + ")<br>"
+                            + "results " + element["result"] + "</a>";
+        return list;
+    };
+
+    var show_page = function(status, page) {
+        var target = document.getElementById(status);
+
+        if (status == "tournament") {
+            page["tournaments"].forEach(function(element) {
+                target.appendChild(tournament_item(element));
+            });
+        } else {
+            page["games"].forEach(function(element) {
+                target.appendChild(game_item(element));
+            });
+        }
+
+        cursors[status] = page["cursor"];
+        document.getElementById(status + "-more").style.display = page["cursor"] == null ? "none" : "inline";
+    };
+
+    var load = function() {
+        // Ignore changes until the lists are loaded.
+        version = null;
+
+        socket.emit("subscribe_lobby", { }, function (data) {
+            statuses.forEach(function(status) {
+                document.getElementById(status).innerHTML = "";
+            });
+
+            if (data == null) {
+                // Changes are not sent, so ask the pages.
+                statuses.forEach(function(status) {
+                    socket.emit("lobby", {"status": status}, function (page) {
+                        show_page(status, page);
+                    });
+                });
+                return;
             }
 
-            var list = document.createElement("li");
-            list.innerHTML = "<a href=" + element["link"] + ">" + element["player1"] + " - " + element["player2"] + "</a>";
-            if (element["gameover"])
-                list.innerHTML += " [" + element["gameover"] + "]";
-            target.appendChild(list);
+            statuses.forEach(function(status) {
+                show_page(status, data[status]);
+            });
+            version = data["version"];
         });
+    };
+
+    statuses.forEach(function(status) {
+        document.getElementById(status + "-more").onclick = function() {
+            socket.emit("lobby", {"status": status, "cursor": cursors[status]}, function (page) {
+                show_page(status, page);
+            });
+        };
     });
 
-    socket.emit("tournament", function (data) {
-        data.forEach(function(element) {
-            var list = document.createElement("li");
-            list.innerHTML = "<a style='white-space: pre;'>" + element["player1"] + " vs. " + element["player2"] + "<br>"
-                                + "win " + element["player1_win"] + " : " + element["player2_win"] + "<br>" 
-                                + "results " + element["result"] + "</a>";
-            document.getElementById("tournament").appendChild(list);
-        });
+    socket.on("lobby_change", function (change) {
+        if (version == null || change["version"] <= version)
+            return;
+
+        if (change["version"] != version + 1) {
+            // A change was missed, so load the lists again.
+            load();
+            return;
+        }
+        version = change["version"];
+
+        var item = null;
+        var target = null;
+
+        if (change["game"]) {
+            item = game_item(change["game"]);
+            target = document.getElementById(change["game"]["status"]);
+        } else {
+            item = tournament_item(change["tournament"]);
+            target = document.getElementById("tournament");
+        }
+
+        // The latest change comes first.
+        var current = document.getElementById(item.id);
+        if (current != null)
+            current.parentNode.removeChild(current);
+        target.insertBefore(item, target.firstChild);
     });
+
+    // The subscription is lost while disconnected.
+    socket.on("reconnect", load);
+
+    load();
 };
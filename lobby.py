@@ -0,0 +1,169 @@
+import bisect
+
+
+STATUSES = ['pending', 'ongoing', 'finished']
+
+def game_status(entry):
+    """Returns the status of the game in the lobby, i.e. `pending`, `ongoing` or `finished`.
+    """
+    if entry['ongoing']:
+        return 'ongoing'
+    elif entry['gameover'] == '':
+        return 'pending'
+    else:
+        return 'finished'
+
+def game_link(id):
+    """Returns the link to the viewer of the game.
+    """
+    return './view?{}'.format(id)
+
+def archived_entry(entry):
+    """Returns the entry in the lobby of a game in the index of the archive, which is ordered by its position.
+    """
+    return {
+        'id': entry['id'],
+        'gameover': entry['gameover'],
+        'ongoing': False,
+        'link': game_link(entry['id']),
+        'player1': "Player1" if entry['player1'] == '(none)' else entry['player1'],
+        'player2': "Player2" if entry['player2'] == '(none)' else entry['player2'],
+        'status': 'finished',
+        'order': -entry['position']
+    }
+
+class Lobby:
+    """Games listed in the lobby by their status, and the version of the list.
+
+    Every change of a game (e.g. a player joins, the game starts or ends) increments the version,
+    so viewers of the lobby apply the changes in order, and know when they missed one.
+    Games in each status are ordered by the version they entered the status, so pages are cut by the version.
+
+    Only the latest `finished_games` finished games are kept in memory, and older pages are read from the index of the archive.
+    Games in the archive are ordered by the negative of their positions, so their cursors are negative.
+    """
+    def __init__(self, finished_games=1000, archive=None):
+        self.version = 0
+
+        # The entries of pending and ongoing games by id, in the order they entered the status.
+        self.active = {'pending': { }, 'ongoing': { }}
+
+        # The entries of the latest finished games, and their orders for bisection.
+        # Note: a finished game never changes its status.
+        self.finished = []
+        self.finished_orders = []
+        self.finished_games = finished_games
+
+        # Archive class of older finished games, or None.
+        self.archive = archive
+
+    def update(self, entry):
+        """Update the entry of the game.
+
+        # Arguments
+            entry: The dictionary of the game, which has `id`, `ongoing`, `gameover`, `player1` and `player2`.
+
+        # Returns
+            The change to send to the viewers, i.e. the version and the entry with its status and order,
+            or None if nothing changed.
+        """
+        status = game_status(entry)
+        current = self.active['pending'].get(entry['id']) or self.active['ongoing'].get(entry['id'])
+
+        if current is None and status == 'finished':
+            # Every game is listed as pending first, so the finished game is already listed or dropped.
+            return None
+
+        if current is not None:
+            if current['status'] == status and all(current[key] == value for (key, value) in entry.items()):
+                return None
+
+            if current['status'] == status:
+                # Same status, e.g. a player joined, so the order is kept.
+                current.update(entry)
+                self.version += 1
+                return {'version': self.version, 'game': current}
+
+            self.active[current['status']].pop(entry['id'])
+
+        self.version += 1
+        entry = dict(entry, status=status, order=self.version)
+
+        if status == 'finished':
+            self.finished.append(entry)
+            self.finished_orders.append(entry['order'])
+
+            # Drop the oldest games in a batch, so that the lists are not copied for every game.
+            if len(self.finished) > 2 * self.finished_games:
+                del self.finished[:len(self.finished) - self.finished_games]
+                del self.finished_orders[:len(self.finished_orders) - self.finished_games]
+        else:
+            self.active[status][entry['id']] = entry
+
+        return {'version': self.version, 'game': entry}
+
+    def bump(self):
+        """Increment the version for a change that is not of a game, e.g. a result of a tournament.
+        """
+        self.version += 1
+        return self.version
+
+    def page(self, status, cursor=None, limit=50):
+        """Returns a page of the games in the status, the latest first.
+
+        # Arguments
+            status: `pending`, `ongoing` or `finished`.
+            cursor: The cursor returned with the previous page, or None for the first page.
+            limit: The maximum number of the games in the page.
+
+        # Returns
+            The dictionary of the games and the cursor of the next page (None if this is the last page).
+        """
+        if status == 'finished':
+            # The latest games are kept in memory beyond the retention until the next batch is dropped.
+            first = max(0, len(self.finished) - self.finished_games)
+
+            if cursor is not None and cursor < 0:
+                games = []
+                more = False
+                before = None if self.archive is None else -cursor
+            else:
+                end = len(self.finished) if cursor is None else max(first, bisect.bisect_left(self.finished_orders, cursor))
+                start = max(first, end - limit)
+                games = self.finished[start:end][::-1]
+                more = start > first
+                before = None if more else self.archived_before(first)
+
+            if before is not None:
+                # Fill the page with older games in the archive, and look one more ahead to know whether they continue.
+                remaining = limit - len(games)
+                entries = self.archive.entries(before, remaining + 1)
+                games += [archived_entry(entry) for entry in entries[:remaining]]
+                more = len(entries) > remaining
+        else:
+            entries = [entry for entry in self.active[status].values() if cursor is None or entry['order'] < cursor]
+            games = entries[-limit:][::-1] if limit > 0 else []
+            more = len(entries) > len(games)
+
+        return {
+            'games': games,
+            'cursor': games[-1]['order'] if more and len(games) > 0 else None
+        }
+
+    def archived_before(self, first):
+        """Returns the position in the archive before which games are older than the finished games in memory.
+
+        # Arguments
+            first: The index of the oldest finished game in memory.
+        """
+        if self.archive is None:
+            return None
+
+        # Games are written in the order they finished, and games being written will have the next positions.
+        before = self.archive.next_position()
+        for entry in self.finished[first:]:
+            archived = self.archive.entry(entry['id'])
+            if archived is not None:
+                return min(before, archived['position'])
+
+        return before
@@ -0,0 +1,152 @@
+import bisect
+import collections
+import time
+
+
+# Upper bounds of the buckets of histograms in seconds.
+BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+class Histogram:
+    """Distribution of durations in seconds.
+    """
+    def __init__(self):
+        # The number of observations in each bucket, and over the last bucket.
+        self.counts = [0 for _ in range(len(BUCKETS) + 1)]
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Timer:
+    """Context manager that measures the time of a stage into the histogram.
+    """
+    __slots__ = ['histogram', 'start']
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class Metrics:
+    """Metrics of the server, rendered in the Prometheus text format.
+    """
+    def __init__(self, rate_window=60):
+        # Time of each stage of handling messages.
+        self.stages = collections.OrderedDict()
+
+        # Delay of periodic ticks, i.e. how long the server was too busy to run them.
+        self.lag = Histogram()
+        self.last_tick = None
+
+        # Functions that return the current values of gauges and counters.
+        self.gauges = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+        self.moves = 0
+
+        # Snapshots of the move count at ticks, to calculate moves per second.
+        self.rate_window = rate_window
+        self.move_snapshots = collections.deque()
+
+    def stage(self, name):
+        """Returns a context manager that measures the time of the stage.
+
+        # Arguments
+            name: The name of the stage (e.g. validate, do_move, repetition, log, display or emit).
+        """
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages[name] = Histogram()
+
+        return Timer(histogram)
+
+    def gauge(self, name, function):
+        """Register a gauge.
+
+        # Arguments
+            name: The name of the gauge.
+            function: The function that returns the current value of the gauge.
+        """
+        self.gauges[name] = function
+
+    def counter(self, name, function):
+        """Register a counter, i.e. a value that only increases.
+
+        # Arguments
+            name: The name of the counter, without `_total`.
+            function: The function that returns the current value of the counter.
+        """
+        self.counters[name] = function
+
+    def count_move(self):
+        self.moves += 1
+
+    def tick(self, interval):
+        """Called every interval seconds by the server, to measure the lag and the rate of moves.
+        """
+        now = time.monotonic()
+
+        if self.last_tick is not None:
+            self.lag.observe(max(0.0, now - self.last_tick - interval))
+        self.last_tick = now
+
+        self.move_snapshots.append((now, self.moves))
+        while now - self.move_snapshots[0][0] > self.rate_window:
+            self.move_snapshots.popleft()
+
+    def moves_per_second(self):
+        if len(self.move_snapshots) < 2:
+            return 0.0
+
+        (start, start_moves) = self.move_snapshots[0]
+        (end, end_moves) = self.move_snapshots[-1]
+        return (end_moves - start_moves) / (end - start)
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format.
+        """
+        lines = []
+
+        def histogram_lines(name, histogram, labels=''):
+            cumulative = 0
+            for (bound, count) in zip(BUCKETS + ['+Inf'], histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, cumulative))
+
+            labels = '{{{}}}'.format(labels.rstrip(',')) if labels != '' else ''
+            lines.append('{}_sum{} {}'.format(name, labels, histogram.sum))
+            lines.append('{}_count{} {}'.format(name, labels, histogram.count))
+
+        lines.append('# HELP minishogi_stage_seconds Time of each stage of handling messages.')
+        lines.append('# TYPE minishogi_stage_seconds histogram')
+        for (stage, histogram) in self.stages.items():
+            histogram_lines('minishogi_stage_seconds', histogram, 'stage="{}",'.format(stage))
+
+        lines.append('# HELP minishogi_loop_lag_seconds Delay of periodic ticks of the event loop.')
+        lines.append('# TYPE minishogi_loop_lag_seconds histogram')
+        histogram_lines('minishogi_loop_lag_seconds', self.lag)
+
+        for (name, function) in self.gauges.items():
+            lines.append('# TYPE minishogi_{} gauge'.format(name))
+            lines.append('minishogi_{} {}'.format(name, function()))
+
+        for (name, function) in self.counters.items():
+            lines.append('# TYPE minishogi_{}_total counter'.format(name))
+            lines.append('minishogi_{}_total {}'.format(name, function()))
+
+        lines.append('# TYPE minishogi_moves_total counter')
+        lines.append('minishogi_moves_total {}'.format(self.moves))
+        lines.append('# TYPE minishogi_moves_per_second gauge')
+        lines.append('minishogi_moves_per_second {}'.format(self.moves_per_second()))
+
+        return '\n'.join(lines) + '\n'
+
+# Metrics of this process.
+metrics = Metrics()
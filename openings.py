@@ -0,0 +1,102 @@
+import collections
+import minishogilib
+import mmap
+
+
+class OpeningSuite:
+    """Initial positions of games, given as a list or loaded from a file.
+
+    The file has one sfen (e.g. `rbsgk/4p/5/P4/KGSBR b - 1 moves 2e3d`) per line.
+    Empty lines and lines beginning with `#` are skipped, and duplicated positions are dropped.
+    The file is memory-mapped, and only the offsets of the lines are kept in memory.
+
+    Parsed positions are cached, so the moves of an opening are replayed only once,
+    and each game gets a copy of the cached position.
+    """
+    def __init__(self, path=None, positions=None, cache_size=1024):
+        self.mmap = None
+
+        # The sfen of each position, or the offsets of its line in the file.
+        self.positions = []
+
+        if path is not None:
+            self.load(path)
+        else:
+            for sfen in dict.fromkeys(sfen.strip() for sfen in positions or []):
+                if sfen != '':
+                    self.positions.append(sfen)
+
+        # Parsed positions, in the order of use.
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            if f.seek(0, 2) == 0:
+                return
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Offsets of the lines by their hash, to find duplicated positions.
+        seen = { }
+
+        start = 0
+        size = len(self.mmap)
+        while start < size:
+            end = self.mmap.find(b'\n', start)
+            if end < 0:
+                end = size
+
+            line = self.mmap[start:end].strip()
+            if len(line) > 0 and not line.startswith(b'#'):
+                duplicates = seen.setdefault(hash(line), [])
+                if all(self.mmap[s:e].strip() != line for (s, e) in duplicates):
+                    duplicates.append((start, end))
+                    self.positions.append((start, end))
+
+            start = end + 1
+
+    def __len__(self):
+        return len(self.positions)
+
+    def sfen(self, index):
+        """Returns the sfen representation of the position.
+        """
+        position = self.positions[index]
+        if isinstance(position, str):
+            return position
+
+        (start, end) = position
+        return self.mmap[start:end].strip().decode('utf-8')
+
+    def position(self, index):
+        """Returns a new Position of the position.
+
+        # Arguments
+            index: The index of the position in the suite.
+        """
+        position = self.cache.get(index)
+
+        if position is None:
+            position = minishogilib.Position()
+            position.set_sfen(self.sfen(index))
+
+            self.cache[index] = position
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(index)
+
+        # Copy with the history, so that repetitions of the opening count.
+        return position.copy(True)
+
+def load_openings(config):
+    """Returns the opening suite of the config, or None if the games start from the start position.
+
+    The positions are loaded from the file `opening_file` if it is set, otherwise from `initial_positions`.
+    """
+    if 'opening_file' in config:
+        return OpeningSuite(path=config['opening_file'], cache_size=config.get('opening_cache_size', 1024))
+    elif 'initial_positions' in config:
+        return OpeningSuite(positions=config['initial_positions'], cache_size=config.get('opening_cache_size', 1024))
+
+    return None
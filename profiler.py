@@ -0,0 +1,185 @@
+import collections
+import datetime
+import dis
+import os
+import sys
+import threading
+import time
+
+
+# Instructions that load a function by its name, and that load an attribute (e.g. a method of minishogilib) of an object.
+NAME_LOADS = ['LOAD_GLOBAL', 'LOAD_NAME', 'LOAD_DEREF']
+ATTRIBUTE_LOADS = ['LOAD_ATTR', 'LOAD_METHOD']
+
+def call_sites(code):
+    """Returns the names of the functions called by the code, by the offset of the call instruction.
+
+    The stack of the interpreter is followed roughly, so that the name is of the function called
+    and not of its arguments (e.g. `sorted` for `sorted(range(n))`).
+    """
+    sites = { }
+    stack = []
+
+    # The function found by PRECALL, which pops the arguments before CALL (Python 3.11).
+    callee = None
+
+    for instruction in dis.get_instructions(code):
+        opname = instruction.opname
+        arg = instruction.arg if instruction.opcode >= dis.HAVE_ARGUMENT else None
+
+        try:
+            effect = dis.stack_effect(instruction.opcode, arg, jump=False)
+        except ValueError:
+            effect = 0
+
+        is_call = opname.startswith('CALL') and arg is not None
+        if (is_call or opname == 'PRECALL') and arg is not None:
+            # The function is below its arguments.
+            depth = arg + 1
+            if callee is None:
+                callee = stack[-depth] if len(stack) >= depth else None
+
+            if is_call:
+                sites[instruction.offset] = callee
+                callee = None
+
+        if opname in ATTRIBUTE_LOADS:
+            # The attribute replaces the object (a method is pushed with the object).
+            if len(stack) > 0:
+                stack.pop()
+            stack.extend([instruction.argval] * (effect + 1))
+        elif opname in NAME_LOADS:
+            stack.extend([instruction.argval] * effect)
+        elif effect < 0:
+            del stack[max(0, len(stack) + effect):]
+        else:
+            stack.extend([None] * effect)
+
+        if is_call and len(stack) > 0:
+            # The result of the call.
+            stack[-1] = None
+
+    return sites
+
+class SamplingProfiler:
+    """Samples the stacks of the threads of the server for a while,
+    and writes them in the collapsed format of flame graphs (e.g. flamegraph.pl or speedscope).
+
+    Only the stacks below the root functions (e.g. the handlers of messages) are kept.
+    Calls of native functions (e.g. of minishogilib) are shown as leaves in brackets, e.g. `[do_move]`.
+
+    Nothing runs until a capture starts, so the server runs at full speed while it is off.
+    """
+    def __init__(self, roots, directory='log/profiles'):
+        """
+        # Arguments
+            roots: The names of the functions whose stacks are kept.
+            directory: The directory the profiles are written in.
+        """
+        self.roots = set(roots)
+        self.directory = directory
+
+        self.thread = None
+
+        # The names of the functions called by each code, kept while capturing.
+        self.sites = { }
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, interval=0.01):
+        """Start a capture in background.
+
+        # Arguments
+            seconds: The duration of the capture.
+            interval: Seconds between samples.
+
+        # Returns
+            The path the profile will be written in, or None if a capture is already running.
+        """
+        if self.is_running():
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{0:%Y-%m-%d-%H%M%S}_profile.folded'.format(datetime.datetime.now()))
+
+        # Note: the thread is not a green thread of eventlet, so it samples the server even while a handler runs.
+        self.thread = threading.Thread(target=self.run, args=[seconds, interval, path], daemon=True)
+        self.thread.start()
+
+        return path
+
+    def run(self, seconds, interval, path):
+        counts = collections.Counter()
+        samples = 0
+
+        # The sampler waits for the GIL until the server releases it, so handlers shorter than the switch interval
+        # would be missed. Switch threads more often while capturing.
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch_interval, interval / 10))
+
+        try:
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                self.sample(counts)
+                samples += 1
+                time.sleep(interval)
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+        with open(path, 'w') as f:
+            for (stack, count) in sorted(counts.items()):
+                f.write('{} {}\n'.format(';'.join(stack), count))
+
+        self.sites.clear()
+        print('INFO: Profile written:', path, 'samples=', samples, 'busy=', sum(counts.values()))
+
+    def sample(self, counts):
+        """Add the stacks of the threads running the root functions.
+        """
+        current = threading.get_ident()
+
+        for (ident, frame) in sys._current_frames().items():
+            if ident == current:
+                continue
+
+            stack = self.stack(frame)
+            if stack is not None:
+                counts[stack] += 1
+
+    def stack(self, frame):
+        """Returns the names of the functions from the outermost root function to the frame, or None if there is no root.
+        """
+        names = []
+        root = None
+
+        leaf = self.native_call(frame)
+        if leaf is not None:
+            names.append('[{}]'.format(leaf))
+
+        while frame is not None:
+            code = frame.f_code
+            names.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+            if code.co_name in self.roots:
+                root = len(names)
+            frame = frame.f_back
+
+        if root is None:
+            return None
+
+        return tuple(reversed(names[:root]))
+
+    def native_call(self, frame):
+        """Returns the name of the function the frame is calling, or None if the frame runs Python code.
+
+        The frame is sampled at a call instruction only while the function is native (e.g. of minishogilib),
+        because a Python function would have its own frame.
+        """
+        code = frame.f_code
+
+        sites = self.sites.get(code)
+        if sites is None:
+            sites = call_sites(code)
+            self.sites[code] = sites
+
+        return sites.get(frame.f_lasti)
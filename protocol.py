@@ -0,0 +1,30 @@
+import zlib
+
+
+# The version of the `/match` protocol.
+# 1: `nextmove` has the whole game in sfen (`position`).
+# 2: `nextmove` has only the last move of the opponent (`move`), and clients keep the game themselves.
+PROTOCOL_VERSION = 2
+
+def position_checksum(position):
+    """Returns the checksum of the position, so that the client knows its position is the same as the server's.
+
+    # Arguments
+        position: The position of minishogilib.
+    """
+    return zlib.crc32(position.sfen(False).encode('utf-8'))
+
+def split_position(sfen):
+    """Split the sfen representation of a game into the initial position and the moves.
+
+    # Arguments
+        sfen: The sfen representation with the moves, e.g. `rbsgk/4p/5/P4/KGSBR b - 1 moves 2e2d 4a3b`.
+
+    # Returns
+        The initial position and the list of the moves.
+    """
+    output = sfen.split(' moves ')
+    if len(output) == 1:
+        return output[0].strip(), []
+
+    return output[0].strip(), output[1].split()
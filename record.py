@@ -0,0 +1,167 @@
+import array
+import minishogilib
+from protocol import split_position
+
+
+# Pieces that can be dropped, in the order of their codes.
+DROP_PIECES = 'GSBRP'
+
+# Keys of the time control, in the order they are kept.
+TIME_CONTROL_KEYS = ['btime', 'wtime', 'byoyomi', 'binc', 'winc']
+
+def square_code(square):
+    """Returns the code of the square in sfen representation (e.g. `2e`), from 0 to 24.
+    """
+    return (int(square[0]) - 1) * 5 + 'abcde'.index(square[1])
+
+def square_sfen(code):
+    return '{}{}'.format(code // 5 + 1, 'abcde'[code % 5])
+
+def pack_move(sfen_move):
+    """Returns the move in sfen representation packed in 11 bits.
+
+    The lower 5 bits are the square the piece moves from (25 and more for the pieces dropped),
+    the next 5 bits are the square the piece moves to, and the top bit is the promotion.
+    """
+    if sfen_move[1] == '*':
+        source = 25 + DROP_PIECES.index(sfen_move[0])
+    else:
+        source = square_code(sfen_move[0:2])
+
+    return source | (square_code(sfen_move[2:4]) << 5) | (int(sfen_move.endswith('+')) << 10)
+
+def unpack_move(code):
+    source = code & 31
+
+    if source >= 25:
+        sfen_move = DROP_PIECES[source - 25] + '*'
+    else:
+        sfen_move = square_sfen(source)
+
+    sfen_move += square_sfen((code >> 5) & 31)
+    if code >> 10:
+        sfen_move += '+'
+
+    return sfen_move
+
+class GameRecord:
+    """A finished game kept in memory in place of Game class.
+
+    Only what the lobby and viewers need is kept, i.e. the initial position, the moves packed in an array,
+    the time consumption and the result, so a finished game costs a few hundred bytes instead of a live position.
+    The rest of the kif (e.g. the scores) is in the archive.
+    """
+    __slots__ = ['id', 'index', 'player1', 'player2', 'initial_sfen', 'moves', 'consumption', 'raw_consumption',
+                 'time_control', 'gameover']
+
+    # A finished game never goes on.
+    ongoing = False
+
+    def __init__(self, id, index, player1, player2, initial_sfen, moves, consumption, raw_consumption, time_control, gameover):
+        """
+        # Arguments
+            id: The id of the game.
+            index: The index of the game in the tournament.
+            player1: The name of the first player, or None.
+            player2: The name of the second player, or None.
+            initial_sfen: The initial position in sfen representation.
+            moves: The moves played after the initial position in sfen representation.
+            consumption: The time charged to the players for each move in milliseconds.
+            raw_consumption: The time measured by the server for each move in milliseconds.
+            time_control: The remaining time of the players at the end, as returned by `Game.time_control`.
+            gameover: The reason of the end of the game.
+        """
+        self.id = id
+        self.index = index
+        self.player1 = player1
+        self.player2 = player2
+        self.initial_sfen = initial_sfen
+        self.moves = array.array('H', [pack_move(move) for move in moves])
+        self.consumption = array.array('I', consumption)
+        self.raw_consumption = array.array('I', raw_consumption)
+        self.time_control = tuple(time_control.get(key, 0) for key in TIME_CONTROL_KEYS)
+        self.gameover = gameover
+
+    @classmethod
+    def from_game(cls, game):
+        """Returns the record of the finished game.
+
+        # Arguments
+            game: Game class.
+        """
+        return cls(str(game.id), game.index,
+                   None if game.clients[0] is None else game.clients[0].name,
+                   None if game.clients[1] is None else game.clients[1].name,
+                   game.initial_sfen, game.moves, game.consumption, game.raw_consumption, game.time_control(), game.gameover)
+
+    @classmethod
+    def from_archive(cls, record):
+        """Returns the record of a game loaded from the archive.
+
+        # Arguments
+            record: The record of the game in the archive, as returned by `Game.record`.
+        """
+        # The moves of the opening are in the initial position.
+        opening = split_position(record['pos'])[1]
+        moves = split_position(record['kif'])[1][len(opening):]
+
+        return cls(record['id'], record['index'], record['player1'], record['player2'], record['pos'], moves,
+                   record['consumption'], record['raw_consumption'], record.get('time_control', { }), record['gameover'])
+
+    def sfen(self):
+        """Returns the game in sfen representation, i.e. the initial position and every move.
+        """
+        start, opening = split_position(self.initial_sfen)
+        moves = opening + [unpack_move(code) for code in self.moves]
+
+        if len(moves) == 0:
+            return start
+
+        return '{} moves {}'.format(start, ' '.join(moves))
+
+    def replay(self):
+        """Returns the position at the end of the game.
+        """
+        position = minishogilib.Position()
+        position.set_sfen(self.sfen())
+        return position
+
+    def snapshot(self, position=None):
+        """Returns the payload sent to viewers, in the same representation as `Game.snapshot`.
+
+        # Arguments
+            position: The position at the end of the game, or None to replay the game.
+        """
+        if position is None:
+            position = self.replay()
+
+        kif = position.get_csa_kif()
+
+        return {
+            'sfen': position.sfen(False),
+            'move': kif[-1] if len(kif) > 0 else None,
+            'kif': kif,
+            'ply': len(kif),
+            'sente': '(none)' if self.player1 is None else self.player1,
+            'gote': '(none)' if self.player2 is None else self.player2,
+            'timelimit': dict(zip(TIME_CONTROL_KEYS, self.time_control)),
+            'side_to_move': position.get_side_to_move(),
+            'ongoing': False,
+            'gameover': self.gameover
+        }
+
+    def record(self):
+        """Returns the kif of the game as a dictionary, in the same representation as `Game.record`
+        except the validation time and the scores, which are only in the archive.
+        """
+        return {
+            'player1': '(none)' if self.player1 is None else self.player1,
+            'player2': '(none)' if self.player2 is None else self.player2,
+            'pos': self.initial_sfen,
+            'kif': self.sfen(),
+            'gameover': self.gameover,
+            'index': self.index,
+            'consumption': list(self.consumption),
+            'raw_consumption': list(self.raw_consumption),
+            'time_control': dict(zip(TIME_CONTROL_KEYS, self.time_control))
+        }
@@ -0,0 +1,40 @@
+import collections
+
+
+class SvgCache:
+    """Boards rendered in SVG for viewers of older pages, which do not render the board themselves.
+
+    The SVG of a board depends only on the position, so it is cached by the sfen representation,
+    and replays and games that reach the same position never render it again.
+    """
+    def __init__(self, size=4096):
+        self.size = size
+
+        # Rendered SVG by the sfen representation, in the order of use.
+        self.cache = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, position):
+        """Returns the SVG of the board.
+
+        # Arguments
+            position: The position of minishogilib.
+        """
+        key = position.sfen(False)
+
+        svg = self.cache.get(key)
+        if svg is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return svg
+
+        self.misses += 1
+        svg = position.to_svg()
+
+        self.cache[key] = svg
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+        return svg
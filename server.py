@@ -1,24 +1,81 @@
+from archive import Archive, checkpoints, safe_filename
+from backend import AsyncioBackend, EventletBackend
+from clock import RoundTripTimes, compensate, now_ms
+import collections
 import datetime
-import eventlet
+import glob
+import hmac
+from lobby import Lobby, STATUSES, game_link
 import math
+from metrics import metrics
 import minishogilib
+from openings import load_openings
 from optparse import OptionParser
 import os
+from profiler import SamplingProfiler
+from protocol import position_checksum
+from record import GameRecord
+from render import SvgCache
+from shard import FrontLedger, fetch_json, spawn_shards
 import simplejson as json
-import socketio
+from sprt import SPRT
 import time
+from timer import TimerWheel
+import traceback
+import urllib.parse
 import uuid
 
 
+PLAYER_STR = ["SENTE", "GOTE"]
+
+# The result of a game that neither player wins.
+DRAW = 2
+
+# The score of a mate in centipawns, i.e. beyond any threshold of adjudication.
+MATE_SCORE = 1000000
+
+# Functions whose stacks are captured by the profiler, i.e. the handlers of messages and what they call.
+PROFILED_FUNCTIONS = ['usi', 'readyok', 'bestmove', 'display', 'quit_engine', 'flag_fall']
+
+def normalize_score(score):
+    """Returns the score reported by the client, or None if it is not a valid score.
+
+    # Arguments
+        score: The score from the view of the engine, i.e. `{'cp': centipawns}` or `{'mate': plies}`.
+            The plies of a mate are negative if the engine is mated.
+    """
+    if not isinstance(score, dict):
+        return None
+
+    for key in ['mate', 'cp']:
+        if isinstance(score.get(key), int) and not isinstance(score[key], bool):
+            return {key: score[key]}
+
+    return None
+
+def score_value(score):
+    """Returns the score in centipawns, counting a mate as MATE_SCORE, or None if the score is unknown.
+    """
+    if score is None:
+        return None
+    elif 'mate' in score:
+        return MATE_SCORE if score['mate'] > 0 else -MATE_SCORE if score['mate'] < 0 else None
+    else:
+        return score['cp']
+
 class Game:
-    def __init__(self, sfen = None):
+    def __init__(self, sfen = None, position = None):
         self.id = uuid.uuid4()
 
-        self.position = minishogilib.Position()
-        if sfen is None:
-            self.position.set_start_position()
+        if position is not None:
+            # A parsed position, e.g. a copy of a position of the opening suite.
+            self.position = position
         else:
-            self.position.set_sfen(sfen)
+            self.position = minishogilib.Position()
+            if sfen is None:
+                self.position.set_start_position()
+            else:
+                self.position.set_sfen(sfen)
 
         # Initial position.
         self.initial_sfen = self.position.sfen(history=True)
@@ -34,13 +91,39 @@ class Game:
         # Stopwatch.
         self.stopwatch = [None for _ in range(2)]
 
-        # Time consumption.
+        # Moves played in the game in sfen representation, after the initial position.
+        self.moves = []
+
+        # Time consumption charged to the players, and as measured by the server before lag compensation.
         self.consumption = []
+        self.raw_consumption = []
+
+        # Legal moves of the current position, and the ply they were generated at.
+        self.legal_moves = { }
+        self.legal_moves_ply = None
+
+        # Time to validate each move in microseconds.
+        self.validation_time = []
+
+        # Scores reported by the players for each move, from the view of the player.
+        self.scores = []
+
+        # Rules to end decided games early.
+        self.adjudication = { }
 
         self.ongoing = False
-        self.gameover = ''  # RESIGN, SENNICHITE, TIME_UP, or ILLEGAL_MOVE
+        self.gameover = ''  # RESIGN, SENNICHITE, TIME_UP, ILLEGAL_MOVE, ADJUDICATED_RESIGN, ADJUDICATED_MATE, or MAX_MOVES
+
+        # Viewers of the game, and viewers of older pages that want the board in SVG.
+        self.viewers = set()
+        self.svg_viewers = set()
+
+        # The kif in CSA representation, to which each move is appended.
+        self.csa_kif = self.position.get_csa_kif()
 
-        self.viewers = []
+        # Payload for viewers, rendered once for each state of the game.
+        self.view = None
+        self.view_key = None
 
         self.tournament = None
         self.index = 0
@@ -51,6 +134,187 @@ class Game:
         self.byoyomi = config['byoyomi']
         self.inc[0] = config['binc']
         self.inc[1] = config['winc']
+        self.adjudication = config.get('adjudication', { })
+
+    def time_control(self):
+        """Returns the remaining time of the players in the representation sent to clients.
+        """
+        return {
+            'btime': self.timelimit[0],
+            'wtime': self.timelimit[1],
+            'byoyomi': self.byoyomi,
+            'binc': self.inc[0],
+            'winc': self.inc[1]
+        }
+
+    def apply_move(self, color, sfen_move, elapsed, raw_elapsed=None, score=None):
+        """Apply the move sent by the player, and judge whether the game ends.
+
+        # Arguments
+            color: The side to move (0=First player, 1=Second player).
+            sfen_move: The sfen representation of the move, or `resign`.
+            elapsed: The time charged to the player in milliseconds.
+            raw_elapsed: The time measured by the server before lag compensation in milliseconds.
+                If None, it is the same as elapsed.
+            score: The score the player reported for the move (see normalize_score), or None.
+
+        # Returns:
+            The winner (0=First player, 1=Second player) or DRAW if the game ends, otherwise None.
+            The reason of the end of the game is set to `gameover`.
+        """
+        # If the client resigns.
+        if sfen_move == 'resign':
+            self.gameover = PLAYER_STR[color] + '_RESIGN'
+            return int(not color)
+
+        # Check whether the sent move is legal.
+        with metrics.stage('validate'):
+            move = self.validate_move(sfen_move)
+        if move is None:
+            self.gameover = PLAYER_STR[color] + '_ILLEGAL_MOVE'
+            return int(not color)
+
+        # Time consumption.
+        elapsed = max(1, math.floor(elapsed))
+        self.consumption.append(elapsed)
+        self.raw_consumption.append(elapsed if raw_elapsed is None else max(1, math.floor(raw_elapsed)))
+        self.scores.append(normalize_score(score))
+
+        if self.timelimit[color] > 0:
+            m = min(self.timelimit[color], elapsed)
+            self.timelimit[color] -= m
+            elapsed -= m
+            self.timelimit[color] += self.inc[color]
+
+        if elapsed > self.byoyomi:
+            # Lose by timelimit.
+            self.gameover = PLAYER_STR[color] + '_TIME_UP'
+            return int(not color)
+
+        # Apply the sent move.
+        with metrics.stage('do_move'):
+            self.csa_kif.append(move.csa())
+            self.position.do_move(move)
+        self.moves.append(sfen_move)
+        metrics.count_move()
+
+        # Is the game end?
+        with metrics.stage('repetition'):
+            is_repetition, is_check_repetition, _ = self.position.is_repetition()
+        if is_check_repetition:
+            self.gameover = PLAYER_STR[color] + '_ILLEGAL_MOVE'
+            return int(not color)
+
+        elif is_repetition:
+            self.gameover = PLAYER_STR[0] + '_SENNICHITE'
+            return 1
+
+        return self.adjudicate(color)
+
+    def adjudicate(self, color):
+        """Judge whether the game is decided by the rules of adjudication, after the move of the player.
+
+        - mate: Both players agree on a mate in their last scores.
+        - resign_score, resign_moves: Both players agree that one of them is behind by resign_score or more
+          in their last resign_moves scores each.
+        - max_ply: The game reaches max_ply, and it is a draw.
+
+        # Arguments
+            color: The player who moved last (0=First player, 1=Second player).
+
+        # Returns:
+            The winner (0=First player, 1=Second player) or DRAW if the game is decided, otherwise None.
+        """
+        # The scores from the view of the first player, the last move first.
+        values = []
+        for (i, score) in enumerate(reversed(self.scores)):
+            value = score_value(score)
+            if value is None:
+                break
+            values.append(value if (color + i) % 2 == 0 else -value)
+
+        if self.adjudication.get('mate', False) and len(values) >= 2:
+            if min(values[:2]) == MATE_SCORE or max(values[:2]) == -MATE_SCORE:
+                winner = 0 if values[0] > 0 else 1
+                self.gameover = PLAYER_STR[1 - winner] + '_ADJUDICATED_MATE'
+                return winner
+
+        if 'resign_score' in self.adjudication:
+            threshold = self.adjudication['resign_score']
+            count = 2 * self.adjudication.get('resign_moves', 3)
+
+            if len(values) >= count:
+                if min(values[:count]) >= threshold or max(values[:count]) <= -threshold:
+                    winner = 0 if values[0] > 0 else 1
+                    self.gameover = PLAYER_STR[1 - winner] + '_ADJUDICATED_RESIGN'
+                    return winner
+
+        if 'max_ply' in self.adjudication and self.position.get_ply() >= self.adjudication['max_ply']:
+            self.gameover = 'MAX_MOVES'
+            return DRAW
+
+        return None
+
+    def validate_move(self, sfen_move):
+        """Check whether the move is legal in the current position.
+
+        Legal moves are generated once for each ply, and looked up by their sfen representation.
+
+        # Arguments
+            sfen_move: The sfen representation of the move.
+
+        # Returns:
+            The move if it is legal, otherwise None.
+        """
+        start_time = time.perf_counter_ns()
+
+        ply = self.position.get_ply()
+        if self.legal_moves_ply != ply:
+            self.legal_moves = {m.sfen(): m for m in self.position.generate_moves()}
+            self.legal_moves_ply = ply
+
+        move = self.legal_moves.get(sfen_move)
+
+        self.validation_time.append((time.perf_counter_ns() - start_time) // 1000)
+
+        return move
+
+    def render_view(self):
+        """Render the payload sent to viewers.
+
+        The payload is cached, and rendered again only if the state of the game changes.
+        The board is sent in sfen representation (with the pieces in hand), and viewers render it.
+
+        # Returns:
+            The dictionary of the current state of the game, with the last move in CSA representation (`move`).
+            The whole CSA kif is only in `snapshot`.
+        """
+        sente = '(none)' if self.clients[0] is None else self.clients[0].name
+        gote = '(none)' if self.clients[1] is None else self.clients[1].name
+
+        key = (self.position.get_ply(), self.ongoing, self.gameover, sente, gote)
+        if self.view is not None and self.view_key == key:
+            return self.view
+
+        self.view = {
+            'sfen': self.position.sfen(False),
+            'move': self.csa_kif[-1] if len(self.csa_kif) > 0 else None,
+            'ply': len(self.csa_kif),
+            'sente': sente,
+            'gote': gote,
+            'timelimit': self.time_control(),
+            'side_to_move': self.position.get_side_to_move(),
+            'ongoing': self.ongoing,
+            'gameover': self.gameover
+        }
+        self.view_key = key
+
+        return self.view
+
+    def snapshot(self):
+        """Returns the payload sent to new viewers and viewers of older pages, i.e. `render_view` with the whole CSA kif (`kif`).
+        """
+        return dict(self.render_view(), kif=list(self.csa_kif))
 
     def dump_csa(self):
         """Dump kif in CSA representation.
@@ -70,14 +334,14 @@ class Game:
         data.append('P5+OU+KI+GI+KA+HI')
         data.append('+')
 
-        csa_kif = self.position.get_csa_kif()
-
-        for (ply, kif) in enumerate(csa_kif):
+        for (ply, kif) in enumerate(self.csa_kif):
             if ply % 2 == 0:
                 data.append('+{}'.format(kif))
             else:
                 data.append('-{}'.format(kif))
             data.append('T{}'.format(self.consumption[ply]))
+            if self.raw_consumption[ply] != self.consumption[ply]:
+                data.append("'raw T{}".format(self.raw_consumption[ply]))
 
         data.append('%{}'.format(self.gameover))
 
@@ -89,6 +353,11 @@ class Game:
         # Returns:
             The string of JSON representation kif of the game.
         """
+        return json.dumps(self.record(), indent=4)
+
+    def record(self):
+        """Returns the kif of the game as a dictionary.
+        """
         data = { }
 
         data['player1'] = '(none)' if self.clients[0] is None else self.clients[0].name
@@ -97,20 +366,26 @@ class Game:
         data['kif'] = self.position.sfen(history=True)
         data['gameover'] = 'on going' if self.gameover == '' else self.gameover
         data['index'] = self.index
+        data['consumption'] = self.consumption
+        data['raw_consumption'] = self.raw_consumption
+        data['validation_time'] = self.validation_time
+        data['scores'] = self.scores
+        data['time_control'] = self.time_control()
 
-        return json.dumps(data, indent=4)
+        return data
 
 class Tournament:
-    def __init__(self, game_count):
+    def __init__(self, game_count, sprt=None):
         print("INFO: Create new tournament")
         # Players name
         self.names = ["" for _ in range(2)]
 
         # Players win count
         self.win = [0 for _ in range(2)]
+        self.draw = 0
 
         # The result of sente or gote win
-        # '*' (on going), '+' (sente win), '-' (gote win), ' ' (wait for start)
+        # '*' (on going), '+' (sente win), '-' (gote win), '=' (draw), ' ' (wait for start)
         self.result = [' ' for _ in range(game_count)]
 
         # The result of games
@@ -119,58 +394,672 @@ class Tournament:
         # Reference of games
         self.games = [None for _ in range(game_count)]
 
+        # The ledger kept by the front server, if games of this tournament are spread over shards.
+        self.ledger = None
+
+        # The test that stops the tournament once the result of the first player is settled, or None to play every game.
+        self.sprt = None if sprt is None else SPRT(**sprt)
+
+    def claim(self, name, swap_turn):
+        """Reserve the next game of the tournament.
+
+        # Arguments
+            name: The name of the player who reserves the game.
+            swap_turn: If true, every position is played twice, and each player goes sente one time.
+
+        # Returns:
+            A tuple of the index of the game, and whether the player is the first player.
+            The index is None if every game is already reserved.
+        """
+        if self.ledger is not None:
+            index, first = self.ledger.claim(name)
+        elif ' ' in self.result and not self.is_decided():
+            index = self.result.index(' ')
+            first = not swap_turn or (index % 2 != (name == self.names[0]))
+        else:
+            index, first = None, False
+
+        if index is not None:
+            self.result[index] = '*'
+
+        return index, first
+
+    def release(self, index):
+        """Abandon the result of the game if it is not finished, so that the game will be played again.
+        """
+        if self.result[index] == '*':
+            self.result[index] = ' '
+
+            if self.ledger is not None:
+                self.ledger.release(index)
+
+    def has_pending(self):
+        """Whether any game of the tournament is waiting for start.
+        """
+        if self.ledger is not None:
+            return self.ledger.has_pending()
+
+        return ' ' in self.result and not self.is_decided()
+
+    def is_decided(self):
+        """Whether the SPRT is over, so that no more game starts.
+        """
+        return self.sprt is not None and self.sprt.decision is not None
+
+    def is_finished(self):
+        """Whether every game of the tournament is finished, or the games on going are finished after the SPRT is over.
+        """
+        return (' ' not in self.result or self.is_decided()) and '*' not in self.result
+
+    def update_sprt(self):
+        if self.sprt is not None and not self.is_decided():
+            if self.sprt.update(self.win[0], self.draw, self.win[1]) is not None:
+                print('INFO: SPRT accepted', self.sprt.decision, 'llr=', self.sprt.llr)
+
     def gameover(self, game, winner):
-        winner_player = (self.names[0] == game.clients[0].name) == winner
-        self.win[winner_player] += 1
-        # Set sente (+) or gote (-) win flag
-        if winner == 0:
-            self.result[game.index] = '+'
+        self.record(game.index, game.clients[0].name, winner, game.gameover)
+
+        if self.ledger is not None:
+            self.ledger.record(game.index, game.clients[0].name, winner, game.gameover)
+
+    def record(self, index, sente, winner, gameover):
+        """Record the result of a game.
+
+        # Arguments
+            index: The index of the game.
+            sente: The name of the first player.
+            winner: The winner of the game (0=First player, 1=Second player), or DRAW.
+            gameover: The reason of the end of the game.
+        """
+        # Set sente (+) or gote (-) win or draw (=) flag
+        if winner == DRAW:
+            self.draw += 1
+            self.result[index] = '='
         else:
-            self.result[game.index] = '-'
-        self.gameovers[game.index] = game.gameover
-        print('index= ', game.index, game.gameover, ' win=', self.win[0], ':', self.win[1], 'results "' + ''.join(self.result) + '"')
+            winner_player = (self.names[0] == sente) == winner
+            self.win[winner_player] += 1
+            if winner == 0:
+                self.result[index] = '+'
+            else:
+                self.result[index] = '-'
+        self.gameovers[index] = gameover
+        self.update_sprt()
+        print('index= ', index, gameover, ' win=', self.win[0], ':', self.win[1], 'draw=', self.draw, 'results "' + ''.join(self.result) + '"')
+
+        # Note: the front server keeps the results if games of this tournament are spread over shards.
+        if self.ledger is None:
+            self.checkpoint()
+
+    def checkpoint_path(self):
+        return 'log/tournaments/' + safe_filename('{}_{}_checkpoint.json'.format(self.names[0], self.names[1]))
+
+    def checkpoint(self):
+        """Save the results so far, so that the tournament resumes after the server restarts.
+
+        The file is written by the background thread, so this returns at once.
+        """
+        data = {
+            'names': self.names,
+            'win': self.win,
+            'draw': self.draw,
+            # Games on going will be played again.
+            'result': ''.join(' ' if r == '*' else r for r in self.result),
+            'gameovers': self.gameovers
+        }
+
+        checkpoints.write(self.checkpoint_path(), json.dumps(data))
 
     def dump(self):
         current_time = '{0:%Y-%m-%d-%H%M%S}'.format(datetime.datetime.now())
-        filename = '{}_{}_{}_trn.txt'.format(current_time, self.names[0], self.names[1])
-
-        # Replace not allowed characters for filename
-        filename = (filename.replace(' ', '-')
-                            .replace(';', '')
-                            .replace(':', '')
-                            .replace('\\', '')
-                            .replace('/', '')
-                            .replace('*', '')
-                            .replace('?', '')
-                            .replace('"', '')
-                            .replace('<', '')
-                            .replace('>', '')
-                            .replace('|', '')
-                            .replace("'", ''))
+        filename = safe_filename('{}_{}_{}_trn.txt'.format(current_time, self.names[0], self.names[1]))
+
         with open("log/tournaments/" + filename, "w") as f:
             f.write('player1= ' + self.names[0] + '\n')
             f.write('player2= ' + self.names[1] + '\n')
             f.write('win= ' + str(self.win[0]) + ':' + str(self.win[1]) + '\n')
+            f.write('draw= ' + str(self.draw) + '\n')
             f.write('results "' + ''.join(self.result) + '"\n')        
+            if self.sprt is not None:
+                f.write('sprt= elo0 {} elo1 {} alpha {} beta {}\n'.format(self.sprt.elo0, self.sprt.elo1, self.sprt.alpha, self.sprt.beta))
+                f.write('llr= {:.3f} ({:.3f}, {:.3f})\n'.format(self.sprt.llr, self.sprt.lower, self.sprt.upper))
+                f.write('decision= ' + str(self.sprt.decision) + '\n')
             for i, g in enumerate(self.gameovers):
                 f.write(str(i+1) + ". " + g + '\n')
 
+        # The tournament is finished, so it will not be resumed.
+        checkpoints.remove(self.checkpoint_path())
+
 class Client:
     def __init__(self):
         self.sid = None
+        # Slot of the engine, if the client plays several games over one connection.
+        self.slot = None
         self.name = ""
         self.readyok = False
         self.disconnect = False
 
-def main(port, config_json):
+        # The version of the `/match` protocol the client speaks.
+        self.protocol = 1
+
+        # Whether the client has the position of the game, so that only the moves are sent (protocol 2).
+        self.synced = False
+
+    def is_sender(self, sid, slot):
+        return self.sid == sid and self.slot == slot
+
+class Registry:
+    """Hosting games and tournaments, indexed for constant time lookups.
+
+    Finished games are kept as records (see GameRecord) up to `finished_games`,
+    and older ones are dropped from memory once they are archived.
+    """
+    def __init__(self, finished_games=1000):
+        # Hosting games by id, in the order of creation.
+        self.games = { }
+
+        # Ids of the finished games kept in memory, in the order they finished,
+        # and of the games that are not archived (e.g. abandoned before start).
+        self.finished = collections.deque()
+        self.unsaved = set()
+        self.finished_games = finished_games
+
+        # Hosting tournaments, in the order of creation, and their indices, i.e. their ids in the lobby.
+        self.tournaments = []
+        self.tournament_ids = { }
+
+        # Which game is this sid's player playing? (for each slot of the client)
+        self.player_game = { }
+
+        # Which games is this sid's viewer watching?
+        self.viewer_games = { }
+
+        # Which unfinished tournament has this player joined?
+        self.name_tournament = { }
+
+        # Tournaments waiting for the second player.
+        self.vacant_tournaments = []
+
+        # Games waiting for the second player.
+        self.vacant_games = []
+
+    def add_game(self, game):
+        self.games[str(game.id)] = game
+
+    def get_game(self, id):
+        return self.games.get(id)
+
+    def finish(self, game, is_archived, save=True):
+        """Replace the finished game with its record, and drop the oldest records beyond the retention.
+
+        # Arguments
+            game: Game class.
+            is_archived: The function that tells whether the game of the id is archived, so that it can be dropped.
+            save: Whether the game is archived. If false, the record is dropped without waiting for the archive.
+        """
+        if self.games.get(str(game.id)) is not game:
+            return
+
+        record = GameRecord.from_game(game)
+        self.games[record.id] = record
+        self.finished.append(record.id)
+        if not save:
+            self.unsaved.add(record.id)
+
+        if game.tournament is not None and game.tournament.games[game.index] is game:
+            game.tournament.games[game.index] = None
+
+        # Note: records not archived yet are dropped with the next finished game.
+        while len(self.finished) > self.finished_games:
+            id = self.finished[0]
+            if id not in self.unsaved and not is_archived(id):
+                break
+
+            self.finished.popleft()
+            self.unsaved.discard(id)
+            del self.games[id]
+
+    def find_vacant_game(self):
+        """Find a one-player reserved game.
+
+        # Returns:
+            The game waiting for the second player, or None.
+        """
+        while len(self.vacant_games) > 0:
+            game = self.vacant_games[0]
+            if game.gameover == '' and game.clients[1] is None:
+                return game
+            self.vacant_games.pop(0)
+
+        return None
+
+    def list_tournament(self, tournament):
+        """Add the tournament to the list of the lobby.
+        """
+        self.tournament_ids[tournament] = len(self.tournaments)
+        self.tournaments.append(tournament)
+
+    def add_tournament(self, tournament):
+        self.list_tournament(tournament)
+        self.name_tournament[tournament.names[0]] = tournament
+        self.vacant_tournaments.append(tournament)
+
+    def resume_tournament(self, tournament):
+        """Add a tournament resumed from a checkpoint, whose players are already known.
+        """
+        self.list_tournament(tournament)
+        self.name_tournament[tournament.names[0]] = tournament
+        self.name_tournament[tournament.names[1]] = tournament
+
+    def find_tournament(self, name):
+        """Find the tournament the player should join.
+
+        # Arguments
+            name: The name of the player.
+
+        # Returns:
+            The unfinished tournament the player already joined, or a tournament waiting for the second player.
+            None if there is no such tournament.
+        """
+        tournament = self.name_tournament.get(name)
+        if tournament is not None and not tournament.is_finished():
+            return tournament
+
+        if len(self.vacant_tournaments) > 0:
+            tournament = self.vacant_tournaments.pop(0)
+            tournament.names[1] = name
+            self.name_tournament[name] = tournament
+            return tournament
+
+        return None
+
+    def set_player(self, client, game):
+        self.player_game.setdefault(client.sid, { })[client.slot] = game
+
+    def get_player_game(self, sid, slot):
+        return self.player_game.get(sid, { }).get(slot)
+
+    def add_viewer(self, sid, game, svg=False):
+        if svg:
+            game.svg_viewers.add(sid)
+        else:
+            game.viewers.add(sid)
+        self.viewer_games.setdefault(sid, set()).add(str(game.id))
+
+    def remove_sid(self, sid):
+        """Forget the sid, and leave every game it was watching.
+
+        # Arguments
+            sid: The sid of the disconnected client.
+
+        # Returns:
+            The list of games the sid was playing.
+        """
+        for id in self.viewer_games.pop(sid, ()):
+            # Note: finished games are replaced with records, which have no viewers.
+            game = self.games.get(id)
+            if isinstance(game, Game):
+                game.viewers.discard(sid)
+                game.svg_viewers.discard(sid)
+
+        return list(self.player_game.pop(sid, { }).values())
+
+class Scheduler:
+    """Games between several engines, played on whichever client slots are idle.
+
+    Each pair of engines in the plan plays a tournament of its own, so the colors are balanced and the results are kept for each pair.
+    Whenever two slots of engines with a pending game between them are idle, the game starts,
+    so every connected client keeps playing until its engine has no game left.
+    """
+    def __init__(self, plan, names, game_count, challenger=None, tournaments=(), sprt=None):
+        """
+        # Arguments
+            plan: `round_robin` (every pair of the engines plays) or `gauntlet` (the challenger plays every other engine).
+            names: The names of the engines.
+            game_count: The number of games of each pair.
+            challenger: The name of the challenger in a gauntlet.
+            tournaments: Tournaments resumed from checkpoints, used for the pairs of the same engines.
+            sprt: The settings of the SPRT of each pair, or None.
+        """
+        self.plan = plan
+        self.names = list(dict.fromkeys(names))
+
+        if plan == 'round_robin':
+            pairs = [(a, b) for (i, a) in enumerate(self.names) for b in self.names[i + 1:]]
+        elif plan == 'gauntlet':
+            pairs = [(challenger, name) for name in self.names if name != challenger]
+        else:
+            raise ValueError('Unknown plan of the schedule: {}'.format(plan))
+
+        resumed = {tuple(sorted(t.names)): t for t in tournaments}
+
+        # The tournament of each pair.
+        self.tournaments = []
+        for pair in pairs:
+            tournament = resumed.get(tuple(sorted(pair)))
+            if tournament is None:
+                tournament = Tournament(game_count, sprt)
+                tournament.names = list(pair)
+            self.tournaments.append(tournament)
+
+        # The tournaments each engine plays.
+        self.name_tournaments = { }
+        for tournament in self.tournaments:
+            for name in tournament.names:
+                self.name_tournaments.setdefault(name, []).append(tournament)
+
+        # Clients waiting for a game, in the order of arrival.
+        self.idle = []
+
+    def is_registered(self, name):
+        return name in self.name_tournaments
+
+    def has_unfinished(self, name):
+        """Whether any game of the engine is not finished.
+        """
+        return any(not t.is_finished() for t in self.name_tournaments.get(name, []))
+
+    def is_finished(self):
+        return all(t.is_finished() for t in self.tournaments)
+
+    def add_idle(self, client):
+        self.idle.append(client)
+
+    def remove_sid(self, sid):
+        self.idle = [client for client in self.idle if client.sid != sid]
+
+    def next_pairing(self, swap_turn):
+        """Reserve a game between two idle clients.
+
+        Of the pairs the first idle client can play, the pair with the most pending games is chosen,
+        so that the pairs progress evenly.
+
+        # Arguments
+            swap_turn: If true, every position is played twice, and each player goes sente one time.
+
+        # Returns:
+            A tuple of the tournament, the index of the game, and the clients of the first and the second player.
+            None if no two idle clients can play.
+        """
+        for client in self.idle:
+            best = None
+
+            for tournament in self.name_tournaments.get(client.name, []):
+                if not tournament.has_pending():
+                    continue
+
+                opponent_name = tournament.names[1] if tournament.names[0] == client.name else tournament.names[0]
+                opponent = next((c for c in self.idle if c.name == opponent_name), None)
+                if opponent is None:
+                    continue
+
+                pending = tournament.result.count(' ')
+                if best is None or pending > best[0]:
+                    best = (pending, tournament, opponent)
+
+            if best is not None:
+                (_, tournament, opponent) = best
+                self.idle.remove(client)
+                self.idle.remove(opponent)
+
+                index, first = tournament.claim(client.name, swap_turn)
+                return tournament, index, [client, opponent] if first else [opponent, client]
+
+        return None
+
+    def retire(self):
+        """Remove the idle clients whose engines have no game left.
+
+        # Returns:
+            The list of the removed clients.
+        """
+        retired = [client for client in self.idle if not self.has_unfinished(client.name)]
+        self.idle = [client for client in self.idle if self.has_unfinished(client.name)]
+
+        return retired
+
+    def dump(self):
+        """Save the standings of the pairs and the engines.
+        """
+        current_time = '{0:%Y-%m-%d-%H%M%S}'.format(datetime.datetime.now())
+
+        # Points of each engine, counting a draw as half a win.
+        points = {name: 0 for name in self.names}
+        games = {name: 0 for name in self.names}
+
+        with open('log/tournaments/' + safe_filename('{}_{}_schedule.txt'.format(current_time, self.plan)), 'w') as f:
+            f.write('plan= ' + self.plan + '\n')
+
+            for t in self.tournaments:
+                f.write('{} vs {} win= {}:{} draw= {}\n'.format(t.names[0], t.names[1], t.win[0], t.win[1], t.draw))
+
+                for (name, win, lose) in [(t.names[0], t.win[0], t.win[1]), (t.names[1], t.win[1], t.win[0])]:
+                    points[name] += win + t.draw / 2
+                    games[name] += win + lose + t.draw
+
+            f.write('standings\n')
+            for name in sorted(self.names, key=lambda name: -points[name]):
+                f.write('{} points= {} games= {}\n'.format(name, points[name], games[name]))
+
+STATIC_FILES = {
+    '/': './html/index.html',
+    '/view': './html/view.html',
+    '/css/': './html/css/',
+    '/js/': './html/js/'
+}
+
+def initial_position(openings, swap_turn, index):
+    """Returns the initial position of the game of the tournament.
+
+    # Arguments
+        openings: The opening suite, or None.
+        swap_turn: If true, every position is played twice.
+        index: The index of the game in the tournament.
+
+    # Returns:
+        The initial position, or None for the start position.
+    """
+    if openings is None or len(openings) == 0:
+        return None
+    elif swap_turn:
+        return openings.position((index // 2) % len(openings))
+    else:
+        return openings.position(index % len(openings))
+
+def load_tournaments(sprt=None):
+    """Load the unfinished tournaments from the checkpoints in log/tournaments.
+
+    The results of finished tournaments (e.g. the SPRT is decided with the current settings) are saved,
+    and their checkpoints are removed.
+
+    # Arguments
+        sprt: The settings of the SPRT of the tournaments, or None.
+
+    # Returns:
+        The list of the tournaments.
+    """
+    tournaments = []
+
+    for path in sorted(glob.glob('log/tournaments/*_checkpoint.json')):
+        with open(path) as f:
+            data = json.load(f)
+
+        tournament = Tournament(len(data['result']), sprt)
+        tournament.names = data['names']
+        tournament.win = data['win']
+        tournament.draw = data.get('draw', 0)
+        tournament.update_sprt()
+        tournament.result = list(data['result'])
+        tournament.gameovers = data['gameovers']
+
+        if tournament.is_finished():
+            # The SPRT is already decided or no game is left, so save the result instead of resuming it.
+            tournament.dump()
+            print('INFO: Tournament finished:', tournament.names[0], 'vs', tournament.names[1])
+            continue
+
+        print('INFO: Resume tournament:', tournament.names[0], 'vs', tournament.names[1],
+              'results "' + ''.join(tournament.result) + '"')
+        tournaments.append(tournament)
+
+    return tournaments
+
+def tournament_entry(index, t):
+    """Returns the data of the tournament shown in the lobby.
+
+    # Arguments
+        index: The index of the tournament in the registry, i.e. its id in the lobby.
+        t: Tournament class.
+    """
+    return {
+        'id': index,
+        'player1': t.names[0],
+        'player2': t.names[1],
+        'player1_win': t.win[0],
+        'player2_win': t.win[1],
+        'draw': t.draw,
+        'result': '"' + ''.join(t.result) + '"'
+    }
+
+def tournament_data(registry):
+    """Returns tournament data.
+    """
+    return [tournament_entry(index, t) for (index, t) in enumerate(registry.tournaments)]
+
+def tournament_page(registry, cursor=None, limit=50):
+    """Returns a page of the tournaments, the latest first.
+
+    # Arguments
+        registry: Registry class.
+        cursor: The cursor returned with the previous page, or None for the first page.
+        limit: The maximum number of the tournaments in the page.
+    """
+    end = len(registry.tournaments) if cursor is None else min(cursor, len(registry.tournaments))
+    start = max(0, end - limit)
+
+    return {
+        'tournaments': [tournament_entry(index, registry.tournaments[index]) for index in reversed(range(start, end))],
+        'cursor': start if 0 < start < end else None
+    }
+
+def game_entry(game):
+    """Returns the data of the game shown in the lobby.
+
+    # Arguments
+        game: Game class, or GameRecord class of a finished game.
+    """
+    if isinstance(game, GameRecord):
+        players = [game.player1, game.player2]
+    else:
+        players = [None if client is None else client.name for client in game.clients]
+
+    return {
+        'id': str(game.id),
+        'gameover': game.gameover,
+        'ongoing': game.ongoing,
+        'link': game_link(game.id),
+        'player1': "Player1" if players[0] is None else players[0],
+        "player2": "Player2" if players[1] is None else players[1]
+    }
+
+def page_query(data, sharded=False):
+    """Returns the status, the cursor and the limit of a request of a page of the lobby.
+
+    The limit is at most 200, so that a page is never too large.
+    If the cursor or the limit is invalid, the limit is 0, so that the page is empty.
+
+    # Arguments
+        data: The request, which has `status`, `cursor` and `limit`.
+        sharded: If true, the cursor of a page of games is the dictionary of the cursors of the shards by their ports.
+    """
+    data = data if isinstance(data, dict) else { }
+    status = data.get('status', 'finished')
+    cursor = data.get('cursor')
+
+    try:
+        limit = max(0, min(int(data.get('limit', 50)), 200))
+
+        if cursor is None:
+            pass
+        elif sharded and status != 'tournament':
+            if not isinstance(cursor, dict):
+                raise TypeError('The cursor of the front server is a dictionary.')
+            cursor = {str(port): int(shard_cursor) for (port, shard_cursor) in cursor.items()}
+        else:
+            cursor = int(cursor)
+    except (TypeError, ValueError):
+        return status, None, 0
+
+    return status, cursor, limit
+
+def get_slot(data):
+    """Returns the slot of the engine that sent the message, or None if the client has only one engine.
+    """
+    return data.get('slot') if isinstance(data, dict) else None
+
+def main(port, config_json, use_asyncio=False, front_url=None):
     with open(config_json) as f:
         config = json.load(f)
 
-    games = []  # Hosting games
-    tournaments = [] # Hosting tournaments
-    sid_game = { }  # Which game is this sid's player playing?
+    registry = Registry(config.get('finished_games', 1000))
+
+    openings = load_openings(config)
+
+    tournaments = load_tournaments(config.get('sprt')) if front_url is None else []
+
+    # Games between several engines, played on idle client slots.
+    scheduler = None
+    if 'schedule' in config:
+        schedule = config['schedule']
+        scheduler = Scheduler(schedule['plan'], schedule['engines'], config['tournament'],
+                              schedule.get('challenger'), tournaments, config.get('sprt'))
+        for tournament in scheduler.tournaments:
+            registry.list_tournament(tournament)
+    else:
+        for tournament in tournaments:
+            registry.resume_tournament(tournament)
+
+    # Finished games are archived in background.
+    archive_config = dict(config.get('archive', { }))
+    archive_config.setdefault('directory', 'log/archive')
+    if front_url is not None:
+        # Each shard has its own archive.
+        archive_config['directory'] = os.path.join(archive_config['directory'], 'shard-{}'.format(port))
+    archive = Archive(**archive_config)
+
+    # Games and tournaments listed in the lobby, whose changes are pushed to viewers of the lobby.
+    # Pages of finished games older than the retention are read from the archive.
+    lobby = Lobby(config.get('finished_games', 1000), archive)
+
+    # Boards in SVG for viewers of older pages.
+    svg_cache = SvgCache(config.get('svg_cache_size', 4096))
+
+    # Round trip times to the clients, and the maximum time not charged to players for the lag in milliseconds.
+    round_trips = RoundTripTimes()
+    max_lag = config.get('max_lag', 1000)
+    lag_margin = config.get('lag_margin', 100)
+
+    # Deadlines of the moves the players are thinking of.
+    flag_timers = TimerWheel(config.get('flag_resolution', 100))
+    flag_grace = config.get('flag_grace', 500)
+
+    sio = AsyncioBackend() if use_asyncio else EventletBackend()
+
+    # The sids and slots of the clients whose games are being reserved on the front server.
+    claiming = set()
 
-    sio = socketio.Server()
+    # The clients that came while a game of the tournament was reserved, by the tournament.
+    reserving = { }
+
+    def send(client, event, data=None):
+        """Send a message to the client.
+
+        If the client plays several games over one connection, the message is tagged with the slot of the engine.
+        """
+        if client.slot is not None:
+            data = {'slot': client.slot, 'message': data} if isinstance(data, str) else dict(data or { }, slot=client.slot)
+
+        with metrics.stage('emit'):
+            sio.emit(event, data, namespace='/match', room=client.sid)
 
     def ask_nextmove(game, color):
         """Ask the client a next move.
@@ -179,106 +1068,179 @@ def main(port, config_json):
             game: Game class.
             color: the side to move (0=First player, 1=Second player).
         """
-        sid = game.clients[color].sid
+        client = game.clients[color]
 
         # Set data that is sent to the client.
-        data = {
-            'position': game.position.sfen(True),
-            'btime': game.timelimit[0],
-            'wtime': game.timelimit[1],
-            'byoyomi': game.byoyomi,
-            'binc': game.inc[0],
-            'winc': game.inc[1]
-        }
+        # Note: the client already has the position of the game except the last move of the opponent,
+        # so the whole game is sent only once.
+        data = game.time_control()
+        if client.synced:
+            data['move'] = game.moves[-1] if len(game.moves) > 0 else None
+        else:
+            data['position'] = game.position.sfen(True)
+            client.synced = client.protocol >= 2
+
+        if client.protocol >= 2:
+            data['ply'] = game.position.get_ply()
+            data['checksum'] = position_checksum(game.position)
 
         # Ask the client a next move.
-        sio.emit('nextmove', data, namespace='/match', room=sid)
+        send(client, 'nextmove', data)
 
         # Begin to measure consumed time.
-        game.stopwatch[color] = time.time_ns() // 1000000
+        game.stopwatch[color] = now_ms()
+
+        # The player loses by time if no move arrives until the deadline.
+        # Note: the increment is added after the move, and the lag is not charged up to max_lag.
+        deadline = game.stopwatch[color] + game.timelimit[color] + game.byoyomi + max_lag + flag_grace
+        flag_timers.schedule(str(game.id), deadline)
+
+    def ping(sid):
+        """Send `clock` message to measure the round trip time to the client.
+        """
+        sio.emit('clock', {'sent': now_ms()}, namespace='/match', room=sid)
 
     def quit_engine(sio, game, save=True):
         """Quit the client.
 
         # Arguments
-            sio: socketio.Server()
+            sio: The socket.io server backend.
             game: Game class.
             save: If true, save the CSA kif of the game.
         """
 
         # Abandon game result if game is not finished
-        if game.tournament.result[game.index] == '*':
-            game.tournament.result[game.index] = ' '
+        if game.tournament is not None:
+            game.tournament.release(game.index)
 
         # Return if game is already closed
         if game.ongoing == False:
-            return        
+            update_lobby(game)
+            if game.gameover != '':
+                # The game was abandoned before start.
+                registry.finish(game, archive.is_archived, save=False)
+            return
         game.ongoing = False
 
+        flag_timers.cancel(str(game.id))
+
+        if len(game.validation_time) > 0:
+            print('INFO: Validation time: moves=', len(game.validation_time),
+                  'mean=', sum(game.validation_time) // len(game.validation_time), 'us',
+                  'max=', max(game.validation_time), 'us')
+
         if save:
-            current_time = '{0:%Y-%m-%d-%H%M%S}'.format(datetime.datetime.now())
-            filename = '{}_{}_{}.json'.format(current_time,
-                                            "Player1" if game.clients[0] is None else game.clients[0].name,
-                                            "Player2" if game.clients[1] is None else game.clients[1].name)
-
-            # Replace not allowed characters for filename
-            filename = (filename.replace(' ', '-')
-                                .replace(';', '')
-                                .replace(':', '')
-                                .replace('\\', '')
-                                .replace('/', '')
-                                .replace('*', '')
-                                .replace('?', '')
-                                .replace('"', '')
-                                .replace('<', '')
-                                .replace('>', '')
-                                .replace('|', '')
-                                .replace("'", ''))
-
-            with open('log/games/' + filename, 'w') as f:
-                f.write(game.dump_json())
-
-        if ' ' not in game.tournament.result or game.clients[0] is None or game.clients[1] is None:
+            with metrics.stage('log'):
+                archive.add(game)
+
+        update_lobby(game)
+
+        # Only the record of the game is kept in memory from now on.
+        registry.finish(game, archive.is_archived, save)
+
+        if scheduler is not None:
+            # Clients whose engines have games left wait for the next pairing.
+            for client in game.clients:
+                if client is None:
+                    continue
+                elif scheduler.has_unfinished(client.name) and not client.disconnect:
+                    send(client, 'restart_engine')
+                else:
+                    send(client, 'disconnect')
+
+            # Idle clients may have no game left now.
+            for client in scheduler.retire():
+                send(client, 'disconnect')
+
+        elif game.tournament is None or not game.tournament.has_pending() or game.clients[0] is None or game.clients[1] is None:
             # Disconnect all clients if all games are going or finished, or any client disconnected
             if game.clients[0] is not None:
-                sio.emit('disconnect', namespace='/match', room=game.clients[0].sid)
+                send(game.clients[0], 'disconnect')
             if game.clients[1] is not None:
-                sio.emit('disconnect', namespace='/match', room=game.clients[1].sid)
+                send(game.clients[1], 'disconnect')
         else:
             # Restart new game
-            sio.emit('restart_engine', namespace='/match', room=game.clients[0].sid)
-            sio.emit('restart_engine', namespace='/match', room=game.clients[1].sid)
+            send(game.clients[0], 'restart_engine')
+            send(game.clients[1], 'restart_engine')
 
         # Save tournament result if all games are finished
-        if ' ' not in game.tournament.result and '*' not in game.tournament.result:
-            game.tournament.dump()
+        # Note: the front server saves the result if games of the tournament are spread over shards.
+        if game.tournament is not None and game.tournament.ledger is None and game.tournament.is_finished():
+            with metrics.stage('log'):
+                game.tournament.dump()
             print("INFO: Tournament finished")
 
+            if scheduler is not None and scheduler.is_finished():
+                scheduler.dump()
+                print("INFO: Schedule finished")
+
+    def update_lobby(game):
+        """Update the game in the lobby, and send the change to viewers of the lobby.
+
+        When a game of a tournament is finished, the result of the tournament is sent too.
+        """
+        change = lobby.update(game_entry(game))
+        if change is None:
+            return
+
+        sio.emit('lobby_change', change, room='lobby')
+
+        index = registry.tournament_ids.get(game.tournament)
+        if change['game']['status'] == 'finished' and index is not None:
+            sio.emit('lobby_change', {'version': lobby.bump(), 'tournament': tournament_entry(index, game.tournament)}, room='lobby')
+
+    def schedule_games():
+        """Start games between the idle clients, and let the clients whose engines have no game left go.
+        """
+        while True:
+            pairing = scheduler.next_pairing(config['swap_turn'])
+            if pairing is None:
+                break
+
+            (tournament, index, clients) = pairing
+
+            game = Game(position=initial_position(openings, config['swap_turn'], index))
+            game.setConfig(config)
+            game.index = index
+            game.tournament = tournament
+            game.clients = clients
+
+            tournament.games[index] = game
+            registry.add_game(game)
+            for client in clients:
+                registry.set_player(client, game)
+
+            print("INFO: Create new game: index=", game.index, game.clients[0].name, "vs", game.clients[1].name)
+            update_lobby(game)
+
+            # Call isready and usinewgame.
+            send(game.clients[0], 'isready')
+            send(game.clients[1], 'isready')
+
+        for client in scheduler.retire():
+            send(client, 'disconnect')
+
     def display(game):
-        """Send the current position of the game to viewer clients.
+        """Send the current state of the game to viewer clients.
+
+        The state is rendered once and broadcast to the room of the game.
+        Viewers that connected with `compact` already have the kif, so only the last move is sent in `display_update`.
+        Viewers of older pages get the whole kif and the board in SVG in `display` in their own room, as before.
         """
+        if len(game.viewers) == 0 and len(game.svg_viewers) == 0:
+            return
 
-        color = game.position.get_side_to_move()
+        with metrics.stage('display'):
+            view = game.render_view()
 
-        timelimit = {
-            'btime': game.timelimit[0],
-            'wtime': game.timelimit[1],
-            'byoyomi': game.byoyomi,
-            'binc': game.inc[0],
-            'winc': game.inc[1]
-        }
+            if len(game.svg_viewers) > 0:
+                svg_view = dict(game.snapshot(), svg=svg_cache.get(game.position))
 
-        for viewer in game.viewers:
-            sio.emit('display', {
-                'svg': None if game.position is None else game.position.to_svg(),
-                'kif': game.position.get_csa_kif(),
-                'sente': game.clients[0].name,
-                'gote': game.clients[1].name,
-                'timelimit': timelimit,
-                'side_to_move': color,
-                'ongoing': game.ongoing,
-                'gameover': game.gameover
-            }, room=viewer)
+        with metrics.stage('emit'):
+            if len(game.viewers) > 0:
+                sio.emit('display_update', view, room=str(game.id))
+            if len(game.svg_viewers) > 0:
+                sio.emit('display', svg_view, room=str(game.id) + '/svg')
 
     # #########################################################################################
     # Socket-IO Events BEGIN
@@ -295,85 +1257,145 @@ def main(port, config_json):
                 # If id is specified, it supposed that a clients want to view the game.
                 id = split[1]
 
-                for game in games:
-                    if id == str(game.id):
-                        game.viewers.append(sid)
-                        display(game)
+                game = registry.get_game(id)
+                # Pages that render the board themselves connect with `compact`.
+                svg = 'compact' not in urllib.parse.parse_qs(data.get('QUERY_STRING', ''))
+
+                if game is None:
+                    # The game was dropped from memory, so load it from the archive.
+                    archived = archive.load(id)
+                    game = None if archived is None else GameRecord.from_archive(archived)
+
+                if isinstance(game, GameRecord):
+                    # The game is finished, so the viewer gets no update.
+                    position = game.replay()
+                    view = game.snapshot(position)
+                    sio.emit('display', dict(view, svg=svg_cache.get(position)) if svg else view, room=sid)
+
+                elif game is not None:
+                    registry.add_viewer(sid, game, svg)
+                    sio.enter_room(sid, str(game.id) + '/svg' if svg else str(game.id))
 
-                        break
+                    # Send the whole state of the game to the new viewer.
+                    view = game.snapshot()
+                    sio.emit('display', dict(view, svg=svg_cache.get(game.position)) if svg else view, room=sid)
 
     @sio.event
     def disconnect(sid, data=None):
         """A clients disconnects from this server.
         """
-        for game in games:
-            if game.clients[0] is not None and game.clients[0].sid == sid and game.clients[0].disconnect == False:
-                game.clients[0].disconnect = True
-                if game.gameover == '':
-                    game.gameover = 'DISCONNECT'
-                quit_engine(sio, game)
-
-            elif game.clients[1] is not None and game.clients[1].sid == sid and game.clients[1].disconnect == False:
-                game.clients[1].disconnect = True
-                if game.gameover == '':
-                    game.gameover = 'DISCONNECT'
-                quit_engine(sio, game)
+        round_trips.forget(sid)
+        claiming.difference_update([key for key in claiming if key[0] == sid])
+        for deferred in reserving.values():
+            deferred[:] = [(deferred_sid, data) for (deferred_sid, data) in deferred if deferred_sid != sid]
+
+        if scheduler is not None:
+            scheduler.remove_sid(sid)
+
+        # If someone leaves the room of a game, the sid plays no game.
+        for game in registry.remove_sid(sid):
+            for client in game.clients:
+                if client is not None and client.sid == sid and client.disconnect == False:
+                    client.disconnect = True
+                    starting = game.gameover == '' and not game.ongoing
+                    if game.gameover == '':
+                        game.gameover = 'DISCONNECT'
+                    quit_engine(sio, game)
+                    display(game)
+
+                    if scheduler is not None and starting:
+                        # The game did not start, so the opponent waits for the next pairing.
+                        for opponent in game.clients:
+                            if opponent is not client:
+                                send(opponent, 'restart_engine')
+                    break
 
-            else:
-                # Someone leaves the room of a game.
-                game.viewers = list(filter(lambda x: x != sid, game.viewers))
+        if scheduler is not None:
+            # The abandoned games may be played by other idle clients.
+            schedule_games()
 
     @sio.on('download')
     def download(sid, id):
         """A viewer wants to download CSA kif.
         """
-        for game in games:
-            if id == str(game.id):
-                current_time = '{0:%Y-%m-%d-%H%M%S}'.format(datetime.datetime.now())
+        game = registry.get_game(id)
 
-                data = {
-                    'kif': game.dump_json(),
-                    'filename': '{}_{}_{}.json'.format(current_time,
-                                                    "Player1" if game.clients[0] is None else game.clients[0].name,
-                                                    "Player2" if game.clients[1] is None else game.clients[1].name)
-                }
+        if isinstance(game, Game):
+            record = game.record()
+        else:
+            # The whole kif of a finished game is in the archive, unless it is being written.
+            record = archive.load(id)
+            if record is None:
+                if game is None:
+                    return
+                record = game.record()
 
-                return data, 200
+            record.pop('id', None)
+            record.pop('date', None)
+
+        current_time = '{0:%Y-%m-%d-%H%M%S}'.format(datetime.datetime.now())
+
+        data = {
+            'kif': json.dumps(record, indent=4),
+            'filename': '{}_{}_{}.json'.format(current_time,
+                                            "Player1" if record['player1'] == '(none)' else record['player1'],
+                                            "Player2" if record['player2'] == '(none)' else record['player2'])
+        }
+
+        return data, 200
+
+    def matching_data():
+        """Returns matching data.
+        """
+        return [game_entry(game) for game in reversed(list(registry.games.values()))]
 
     @sio.on('matching')
     def matching(sid):
         """Returns matching data.
         """
-        data = []
-
-        for game in reversed(games):
-            game_data = {
-                'gameover': game.gameover,
-                'ongoing': game.ongoing,
-                'link': './view?{}'.format(game.id),
-                'player1': "Player1" if game.clients[0] is None else game.clients[0].name,
-                "player2": "Player2" if game.clients[1] is None else game.clients[1].name
-            }
-
-            data.append(game_data)
-        return data
+        return matching_data()
 
     @sio.on('tournament')
     def tournament(sid):
         """Returns tournament data.
         """
-        data = []
+        return tournament_data(registry)
 
-        for t in tournaments:
-            tournament_data = {
-                'player1': t.names[0],
-                'player2': t.names[1],
-                'player1_win': t.win[0],
-                'player2_win': t.win[1],
-                'result': '"' + ''.join(t.result) + '"'
-            }
-            data.append(tournament_data)
-        return data
+    def lobby_page(data):
+        status, cursor, limit = page_query(data)
+
+        if status == 'tournament':
+            page = tournament_page(registry, cursor, limit)
+        elif status in STATUSES:
+            page = lobby.page(status, cursor, limit)
+        else:
+            page = {'games': [], 'cursor': None}
+
+        page['version'] = lobby.version
+        return page
+
+    @sio.on('lobby')
+    def lobby_request(sid, data=None):
+        """Returns a page of the games in a status (`pending`, `ongoing` or `finished`) or of the tournaments (`tournament`).
+        """
+        return lobby_page(data)
+
+    @sio.on('subscribe_lobby')
+    def subscribe_lobby(sid, data=None):
+        """A viewer of the lobby wants the changes of the games.
+
+        # Returns:
+            The version of the lobby, and the first page of each status and of the tournaments.
+            The changes after the version are sent as `lobby_change` messages.
+        """
+        sio.enter_room(sid, 'lobby')
+
+        limit = page_query(data)[2]
+        snapshot = {status: lobby.page(status, None, limit) for status in STATUSES}
+        snapshot['tournament'] = tournament_page(registry, None, limit)
+        snapshot['version'] = lobby.version
+
+        return snapshot
 
     @sio.on('usi', namespace='/match')
     def usi(sid, data):
@@ -381,37 +1403,63 @@ def main(port, config_json):
 
         If a client sends `usi` command, it supposed that the client wants to have a match.
         """
+        tournament = join(sid, data)
+
+        # The clients that came while the game was reserved on the front server look for a room now.
+        if tournament is not None:
+            for (deferred_sid, deferred_data) in reserving.pop(tournament):
+                usi(deferred_sid, deferred_data)
+
+    def join(sid, data):
+        """Seat the client in a game.
+
+        # Returns:
+            The tournament of the game the client reserved, or None if it reserved no game.
+        """
+        client = Client()
+        client.sid = sid
+        client.slot = get_slot(data)
 
         # A client sends `usi` commands, but the name field is None.
         if not 'name' in data:
-            sio.emit('error', 'You sent a request but name field was None.',
-                    namespace='/match', room=sid)
+            send(client, 'error', 'You sent a request but name field was None.')
+            return
+
+        client.name = data['name']
+        client.protocol = data.get('protocol', 1)
+
+        if scheduler is not None:
+            if not scheduler.is_registered(client.name):
+                send(client, 'error', 'The engine is not in the schedule.')
+                return
+
+            send(client, 'info', 'Correctly accepted.')
+            ping(sid)
+
+            # The client waits until an opponent is idle.
+            scheduler.add_idle(client)
+            schedule_games()
             return
 
         game = None
         if 'tournament' in config:
-            tournament = None
-            # Find is program is already joined to a tournament
-            for t in tournaments:
-                if (t.names[0] == data['name'] or t.names[1] == data['name']) and (' ' in t.result or '*' in t.result):
-                    tournament = t
-                    break
-            # Find a tournament to join
-            if tournament is None:
-                for t in tournaments:
-                    if t.names[1] == "":
-                        tournament = t
-                        tournament.names[1] = data['name']
-                        break
+            # Find a tournament the program already joined, or a tournament to join
+            tournament = registry.find_tournament(data['name'])
             # Create a new tournament
             if tournament is None:
-                tournament = Tournament(config['tournament'])
+                if front_url is not None:
+                    # Only the front server tests the results of the whole tournament.
+                    tournament = Tournament(config['tournament'])
+                    tournament.ledger = FrontLedger(front_url, data['name'], sio.blocking)
+                else:
+                    tournament = Tournament(config['tournament'], config.get('sprt'))
                 tournament.names[0] = data['name']
-                tournaments.append(tournament)
+                registry.add_tournament(tournament)
 
-            client = Client()
-            client.sid = sid
-            client.name = data['name']
+            # Another client is reserving a game of the tournament, and the client may be its opponent.
+            if tournament in reserving:
+                reserving[tournament].append((sid, data))
+                return
 
             # Find a room that current program haven't join in
             for g in tournament.games:
@@ -427,183 +1475,420 @@ def main(port, config_json):
                     break
 
             if game is None:
-                index = tournament.result.index(' ')
-                if 'initial_positions' not in config:
-                    initial_sfen = None
-                elif config['swap_turn']:
-                    position_id = math.floor(index / 2) % len(config['initial_positions'])
-                    initial_sfen = config['initial_positions'][position_id]
-                else:
-                    position_id = index % len(config['initial_positions'])
-                    initial_sfen = config['initial_positions'][position_id]
-                game = Game(initial_sfen)
+                # Note: other handlers run while the front server reserves the game, so the client may disconnect.
+                reserving[tournament] = []
+                claiming.add((sid, client.slot))
+                try:
+                    index, first = tournament.claim(client.name, config['swap_turn'])
+                except Exception:
+                    traceback.print_exc()
+                    send(client, 'error', 'The front server did not reserve a game.')
+                    claiming.discard((sid, client.slot))
+                    return tournament
+
+                if (sid, client.slot) not in claiming:
+                    # The client disconnected, so the game will be played by others.
+                    if index is not None:
+                        tournament.release(index)
+                    return tournament
+                claiming.remove((sid, client.slot))
+
+                if index is None:
+                    send(client, 'error', 'Every game of the tournament has already started.')
+                    return tournament
+
+                game = Game(position=initial_position(openings, config['swap_turn'], index))
                 game.setConfig(config)
                 game.index = index
 
-                if not config['swap_turn'] or (index % 2 != (client.name == tournament.names[0])):
+                if first:
                     game.clients[0] = client
                 else:
                     game.clients[1] = client
                 
-                games.append(game)
+                registry.add_game(game)
 
-                # Set 'on going' flag
-                tournament.result[index] = '*'
                 tournament.games[index] = game
 
-            sid_game[sid] = game
+            registry.set_player(client, game)
             game.tournament = tournament
 
         else:
             # If there is a one-player reserved game, set the client as the second player.
-            for g in games:
-                if g.gameover == '' and g.gameover == '' and g.clients[1] is None:
-                    game = g
-                    break
+            game = registry.find_vacant_game()
 
             # If there is no one-player reserved game, set the client as the first player.
             if game is None:
-                game = Game(None if 'initial_positions' not in config else config['initial_positions'][0])
+                game = Game(position=initial_position(openings, False, 0))
                 game.setConfig(config)
-                games.append(game)
+                registry.add_game(game)
+                registry.vacant_games.append(game)
 
-            sid_game[sid] = game
+            registry.set_player(client, game)
 
             # For some reason an on-going game is selected as the target game, but this is an error.
             if game.clients[1] is not None:
-                sio.emit('error', 'The game has already started.',
-                        namespace='/match', room=sid)
+                send(client, 'error', 'The game has already started.')
                 return
 
-            client = Client()
-            client.sid = sid
-            client.name = data['name']
-
             if game.clients[0] is None:
                 game.clients[0] = client
             else:
                 game.clients[1] = client
 
-        sio.emit('info', 'Correctly accepted.', namespace='/match', room=sid)
+        send(client, 'info', 'Correctly accepted.')
+        ping(sid)
+
+        update_lobby(game)
 
         if game.clients[0] is not None and game.clients[1] is not None:
             # Two players sit down, so a game is starting.
             print("INFO: Create new game: index=", game.index, game.clients[0].name, "vs", game.clients[1].name)
 
             # Call isready and usinewgame.
-            sio.emit('isready', namespace='/match', room=game.clients[0].sid)
-            sio.emit('isready', namespace='/match', room=game.clients[1].sid)
+            send(game.clients[0], 'isready')
+            send(game.clients[1], 'isready')
+
+        return game.tournament if game.tournament in reserving else None
 
     @sio.on('readyok', namespace='/match')
     def readyok(sid, data=None):
         """`readyok` message is sent from a client.
         """
-        game = sid_game[sid]
+        slot = get_slot(data)
+        game = registry.get_player_game(sid, slot)
+
+        # The game was abandoned before it started (e.g. the opponent disconnected).
+        if game is None or game.gameover != '':
+            return
+
         color = game.position.get_side_to_move()
 
         for client in game.clients:
-            if client.sid == sid:
+            if client.is_sender(sid, slot):
                 client.readyok = True
 
         if game.clients[0].readyok and game.clients[1].readyok:
             # Send `usinewgame` message to the clients.
-            sio.emit('usinewgame', namespace='/match', room=game.clients[0].sid)
-            sio.emit('usinewgame', namespace='/match', room=game.clients[1].sid)
+            send(game.clients[0], 'usinewgame')
+            send(game.clients[1], 'usinewgame')
 
             # Ask a first move.
             game.ongoing = True
             ask_nextmove(game, color)
 
             display(game)
+            update_lobby(game)
+
+    @sio.on('clock', namespace='/match')
+    def clock(sid, data):
+        """`clock` message came back from a client.
+        """
+        round_trips.sample(sid, data['sent'])
+
+    @sio.on('resync', namespace='/match')
+    def resync(sid, data=None):
+        """`resync` message is sent from a client whose position differs from the server's.
+
+        The whole game is sent again, and the time keeps running.
+        """
+        slot = get_slot(data)
+        game = registry.get_player_game(sid, slot)
+
+        if game is None or not game.ongoing:
+            return
+
+        color = game.position.get_side_to_move()
+        client = game.clients[color]
+        if not client.is_sender(sid, slot):
+            return
+
+        data = game.time_control()
+        data['position'] = game.position.sfen(True)
+        data['ply'] = game.position.get_ply()
+        data['checksum'] = position_checksum(game.position)
+
+        send(client, 'nextmove', data)
 
     @sio.on('bestmove', namespace='/match')
     def bestmove(sid, data):
         """`bestmove` message is sent from a client.
         """
-        PLAYER_STR = ["SENTE", "GOTE"]
+        slot = get_slot(data)
+        game = registry.get_player_game(sid, slot)
 
-        game = sid_game[sid]
+        # The game is already over (e.g. the player lost by time), so discard it.
+        if game is None or not game.ongoing:
+            return
 
         color = game.position.get_side_to_move()
 
         # An unknown player sent 'bestmove' command, so discard it.
-        if game.clients[color].sid != sid:
+        if not game.clients[color].is_sender(sid, slot):
             return
 
-        sfen_move = data
+        sfen_move = data['move'] if isinstance(data, dict) else data
 
-        # If the client resigns.
-        if sfen_move == 'resign':
-            game.gameover = PLAYER_STR[color] + '_RESIGN'
-            game.tournament.gameover(game, int(not color))
-            quit_engine(sio, game)
-            display(game)
-            return
+        # Time consumption.
+        # Note: the client reports the time the engine thought, and the rest is the lag.
+        raw_elapsed = now_ms() - game.stopwatch[color]
+        think = data.get('think') if isinstance(data, dict) else None
+        elapsed = compensate(raw_elapsed, think, round_trips.get(sid), max_lag, lag_margin)
 
-        # Check whether the sent move is legal.
-        legal_moves = game.position.generate_moves()
-        if not sfen_move in [m.sfen() for m in legal_moves]:
-            game.gameover = PLAYER_STR[color] + '_ILLEGAL_MOVE'
-            game.tournament.gameover(game, int(not color))
+        # The score the engine reported, for adjudication.
+        score = data.get('score') if isinstance(data, dict) else None
+
+        with metrics.stage('bestmove'):
+            winner = game.apply_move(color, sfen_move, elapsed, raw_elapsed, score)
+
+        # Note: the end of a game may wait for the front server, which is timed in its own stage.
+        if winner is not None:
+            if game.tournament is not None:
+                game.tournament.gameover(game, winner)
             quit_engine(sio, game)
-            display(game)
-            return
 
-        move = game.position.sfen_to_move(sfen_move)
+        else:
+            # Ask the other player to send a next move.
+            ask_nextmove(game, 1 - color)
 
-        # Time consumption.
-        current_time = time.time_ns() // 1000000
-        elapsed = max(1, math.floor(current_time - game.stopwatch[color]))
-        game.consumption.append(elapsed)
+        display(game)
 
-        if game.timelimit[color] > 0:
-            m = min(game.timelimit[color], elapsed)
-            game.timelimit[color] -= m
-            elapsed -= m
-            game.timelimit[color] += game.inc[color]
+    # #########################################################################################
+    # Socket-IO Events END
+    # #########################################################################################
+
+    metrics.gauge('games', lambda: sum(1 for game in registry.games.values() if game.ongoing))
+    metrics.gauge('viewers', lambda: len(registry.viewer_games))
+    metrics.gauge('finished_games', lambda: len(registry.finished))
+    metrics.gauge('clients', lambda: sum(len(slots) for slots in registry.player_game.values()))
+    metrics.counter('svg_cache_hits', lambda: svg_cache.hits)
+    metrics.counter('svg_cache_misses', lambda: svg_cache.misses)
+
+    # Measure the lag of the server and the rate of moves.
+    metrics_interval = config.get('metrics_interval', 1.0)
+    sio.every(metrics_interval, lambda: metrics.tick(metrics_interval))
+
+    def flag_fall():
+        """End the games whose players did not send a move until the deadline.
+        """
+        for id in flag_timers.expire(now_ms()):
+            game = registry.get_game(id)
+            if game is None or not game.ongoing:
+                continue
+
+            color = game.position.get_side_to_move()
+            print('INFO: Flag fall: index=', game.index, game.clients[color].name)
 
-        if elapsed > game.byoyomi:
-            # Lose by timelimit.
             game.gameover = PLAYER_STR[color] + '_TIME_UP'
-            game.tournament.gameover(game, int(not color))
+            if game.tournament is not None:
+                game.tournament.gameover(game, 1 - color)
             quit_engine(sio, game)
+            display(game)
+
+    sio.every(flag_timers.resolution / 1000, flag_fall)
 
+    # Measure the round trip times to the players.
+    def ping_players():
+        # Players may connect or disconnect while the messages are sent.
+        for sid in list(registry.player_game):
+            ping(sid)
+
+    sio.every(config.get('rtt_interval', 5.0), ping_players)
+
+    # Profiles of the handlers, captured on demand by the admin.
+    profiler = SamplingProfiler(PROFILED_FUNCTIONS)
+    admin_token = config.get('admin_token')
+
+    def profile(query):
+        """Start to capture the profile of the handlers for `seconds` (default 10, at most 300),
+        sampling every `interval` milliseconds (default 10). The profile is written in log/profiles.
+
+        Only the admin can start it, i.e. with `token` of the admin token in the config.
+        """
+        # Note: the tokens are compared in bytes, since compare_digest rejects str with non-ASCII characters.
+        token = str(query.get('token', '')).encode('utf-8')
+        if admin_token is None or not hmac.compare_digest(token, str(admin_token).encode('utf-8')):
+            return 'text/plain', 'Forbidden\n', 403
+
+        try:
+            seconds = min(float(query.get('seconds', 10)), 300)
+            interval = max(float(query.get('interval', 10)), 1) / 1000
+        except ValueError:
+            return 'text/plain', 'seconds and interval must be numbers\n', 400
+
+        path = profiler.start(seconds, interval)
+        if path is None:
+            return 'text/plain', 'A profile is already being captured\n', 409
+
+        print('INFO: Capture profile:', seconds, 'seconds to', path)
+        return 'text/plain', path + '\n'
+
+    routes = {
+        '/metrics': lambda query: ('text/plain; version=0.0.4', metrics.render()),
+        '/admin/profile': profile
+    }
+    if front_url is not None:
+        # The front server merges matching data of shards.
+        routes['/shard/matching'] = lambda query: ('application/json', json.dumps(matching_data()))
+        routes['/shard/lobby'] = lambda query: ('application/json', json.dumps(lobby_page(query)))
+
+    sio.serve(port, STATIC_FILES, routes)
+
+def front(port, config_json, workers, use_asyncio=False):
+    """Route players to shard servers, and keep the tournaments of the shards.
+
+    Each shard is a server process listening on one of the following ports.
+    Shards reserve games of a tournament and report the results through the front server,
+    so the games of a tournament are spread over shards.
+
+    # Arguments
+        port: The port to listen.
+        config_json: The config json file shared with the shards.
+        workers: The number of shards.
+        use_asyncio: If true, serve with asyncio instead of eventlet.
+    """
+    with open(config_json) as f:
+        config = json.load(f)
+
+    if 'schedule' in config:
+        print('ERROR: Schedules of several engines are played on one server, so run the server without --workers.')
+        return
+
+    shard_ports = spawn_shards(port, config_json, workers, use_asyncio)
+
+    registry = Registry()
+    route_count = { }
+
+    for tournament in load_tournaments(config.get('sprt')):
+        registry.resume_tournament(tournament)
+
+    sio = AsyncioBackend() if use_asyncio else EventletBackend()
+
+    def route(query):
+        """A client asks which shard to join.
+
+        In tournament mode, the k-th client of each player joins the same shard,
+        otherwise every two clients join the same shard.
+        """
+        name = query.get('name', '')
+
+        if 'tournament' in config:
+            if registry.find_tournament(name) is None:
+                tournament = Tournament(config['tournament'], config.get('sprt'))
+                tournament.names[0] = name
+                registry.add_tournament(tournament)
+            key = name
         else:
-            # Apply the sent move.
-            game.position.do_move(move)
-
-            # Is the game end?
-            is_repetition, is_check_repetition, _ = game.position.is_repetition()
-            legal_moves = game.position.generate_moves()
-            if is_check_repetition:
-                game.gameover = PLAYER_STR[color] + '_ILLEGAL_MOVE'
-                game.tournament.gameover(game, int(not color))
-                quit_engine(sio, game)
-
-            elif is_repetition:
-                game.gameover = PLAYER_STR[0] + '_SENNICHITE'
-                game.tournament.gameover(game, 1)
-                quit_engine(sio, game)
+            key = None
 
-            else:
-                # Ask the other player to send a next move.
-                ask_nextmove(game, 1 - color)
+        count = route_count.get(key, 0)
+        route_count[key] = count + 1
 
-        display(game)
+        shard = count % workers if key is not None else (count // 2) % workers
+        return 'application/json', json.dumps({'port': shard_ports[shard]})
 
-    # #########################################################################################
-    # Socket-IO Events END
-    # #########################################################################################
+    def claim(query):
+        tournament = registry.name_tournament.get(query['name'])
+        if tournament is None:
+            return 'application/json', json.dumps({'index': None, 'first': False})
+
+        index, first = tournament.claim(query['name'], config['swap_turn'])
+        return 'application/json', json.dumps({'index': index, 'first': first})
+
+    def release(query):
+        registry.name_tournament[query['name']].release(int(query['index']))
+        return 'application/json', json.dumps({ })
+
+    def pending(query):
+        tournament = registry.name_tournament[query['name']]
+        return 'application/json', json.dumps({'pending': tournament.has_pending()})
+
+    def record(query):
+        tournament = registry.name_tournament[query['name']]
+        tournament.record(int(query['index']), query['sente'], int(query['winner']), query['gameover'])
+
+        # Save tournament result if all games are finished
+        if tournament.is_finished():
+            tournament.dump()
+            print("INFO: Tournament finished")
+
+        return 'application/json', json.dumps({ })
+
+    @sio.on('matching')
+    def matching(sid):
+        """Returns matching data merged from the shards.
+        """
+        data = []
+
+        # Note: shards ask the front server to reserve games meanwhile, so other handlers run while a shard is waited for.
+        for shard_port in shard_ports:
+            for game_data in sio.blocking(fetch_json, shard_port, '/shard/matching'):
+                # Viewers watch the game on the shard.
+                game_data['port'] = shard_port
+                data.append(game_data)
+
+        return data
+
+    @sio.on('tournament')
+    def tournament(sid):
+        """Returns tournament data.
+        """
+        return tournament_data(registry)
+
+    @sio.on('lobby')
+    def lobby_request(sid, data=None):
+        """Returns a page of the lobby merged from the shards.
 
-    static_files = {
-        '/': './html/index.html',
-        '/view': './html/view.html',
-        '/css/': './html/css/',
-        '/js/': './html/js/'
+        The cursor of the page is the dictionary of the cursors of the shards.
+        """
+        status, cursor, limit = page_query(data, sharded=True)
+
+        if status == 'tournament':
+            return tournament_page(registry, cursor, limit)
+
+        page = {'games': [], 'cursor': { }}
+        for shard_port in shard_ports:
+            params = {'status': status, 'limit': limit}
+            if cursor is not None:
+                if cursor.get(str(shard_port)) is None:
+                    # No more game in the shard.
+                    continue
+                params['cursor'] = cursor[str(shard_port)]
+
+            shard_page = sio.blocking(fetch_json, shard_port, '/shard/lobby', params)
+            for game_data in shard_page['games']:
+                # Viewers watch the game on the shard.
+                game_data['port'] = shard_port
+                page['games'].append(game_data)
+
+            if shard_page['cursor'] is not None:
+                page['cursor'][str(shard_port)] = shard_page['cursor']
+
+        if len(page['cursor']) == 0:
+            page['cursor'] = None
+
+        return page
+
+    @sio.on('subscribe_lobby')
+    def subscribe_lobby(sid, data=None):
+        """Changes of the games are kept by the shards and not sent by the front server, so the lobby asks pages instead.
+        """
+        return None
+
+    @sio.on('usi', namespace='/match')
+    def usi(sid, data):
+        sio.emit('error', 'This server routes clients to shards, so ask /front/route which shard to join.',
+                namespace='/match', room=sid)
+
+    routes = {
+        '/front/route': route,
+        '/front/claim': claim,
+        '/front/release': release,
+        '/front/pending': pending,
+        '/front/record': record
     }
 
-    app = socketio.WSGIApp(sio, static_files=static_files)
-    eventlet.wsgi.server(eventlet.listen(('', port)), app, log_output=False)
+    sio.serve(port, STATIC_FILES, routes)
 
 if __name__ == '__main__':
     parser = OptionParser()
@@ -611,7 +1896,16 @@ if __name__ == '__main__':
                       help='confile json file', default='./server.json')
     parser.add_option('-p', '--port', dest='port',
                       help='target port', type='int', default=8000)
+    parser.add_option('--asyncio', dest='use_asyncio', action='store_true',
+                      help='serve with asyncio instead of eventlet', default=False)
+    parser.add_option('-w', '--workers', dest='workers',
+                      help='the number of shard server processes', type='int', default=1)
+    parser.add_option('--front', dest='front_url',
+                      help='url of the front server (used by shard server processes)', default=None)
 
     (options, args) = parser.parse_args()
 
-    main(port=options.port, config_json=options.config_json)
+    if options.workers > 1:
+        front(port=options.port, config_json=options.config_json, workers=options.workers, use_asyncio=options.use_asyncio)
+    else:
+        main(port=options.port, config_json=options.config_json, use_asyncio=options.use_asyncio, front_url=options.front_url)
@@ -0,0 +1,118 @@
+import atexit
+from backend import report_failure
+import concurrent.futures
+from metrics import metrics
+import os
+import requests
+import signal
+import subprocess
+import sys
+
+
+def fetch_json(port, path, params=None):
+    """Send a request to a server on this machine, and return the JSON response.
+
+    # Arguments
+        port: The port of the server.
+        path: The path of the request.
+        params: The query parameters.
+
+    # Returns
+        The decoded JSON response.
+    """
+    response = requests.get('http://localhost:{}{}'.format(port, path), params=params, timeout=10)
+    response.raise_for_status()
+    return response.json()
+
+def spawn_shards(port, config_json, workers, use_asyncio=False):
+    """Start shard server processes, which listen on the ports following the port of the front server.
+
+    Shards are interrupted when the front server exits, so that they write the rest of their archives.
+
+    # Arguments
+        port: The port of the front server.
+        config_json: The config json file.
+        workers: The number of shards.
+        use_asyncio: If true, shards serve with asyncio instead of eventlet.
+
+    # Returns
+        The list of ports of the shards.
+    """
+    server_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+    shard_ports = []
+    processes = []
+    for shard in range(workers):
+        shard_port = port + 1 + shard
+
+        command = [sys.executable, server_py,
+                   '--port', str(shard_port),
+                   '--config', config_json,
+                   '--front', 'http://localhost:{}'.format(port)]
+        if use_asyncio:
+            command.append('--asyncio')
+
+        processes.append(subprocess.Popen(command))
+        shard_ports.append(shard_port)
+
+    def terminate():
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+
+    atexit.register(terminate)
+
+    return shard_ports
+
+class FrontLedger:
+    """Results of a tournament kept by the front server.
+
+    Shards reserve games of the tournament and report the results through the front server,
+    so that each game of the tournament is played exactly once on one of the shards.
+
+    The front server asks the shards for their games too, so the requests never block the handlers of the shard:
+    they are sent in order on a thread, the results and the releases are not waited for,
+    and other handlers run while a reservation is waited for.
+    """
+    def __init__(self, front_url, name, blocking):
+        """
+        # Arguments
+            front_url: The url of the front server.
+            name: The name of a player of the tournament, by which the front server finds the tournament.
+            blocking: The function of the backend that calls a blocking function without blocking other handlers.
+        """
+        self.front_url = front_url
+        self.name = name
+        self.blocking = blocking
+
+        # The thread that sends the requests in order.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def request(self, path, params):
+        params['name'] = self.name
+        response = requests.get(self.front_url + path, params=params, timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+    def send(self, path, **params):
+        """Send a request without waiting for the response.
+        """
+        self.executor.submit(self.request, path, params).add_done_callback(report_failure)
+
+    def ask(self, path, **params):
+        """Send a request after the previous ones, and wait for the response while other handlers run.
+        """
+        with metrics.stage('front'):
+            return self.blocking(self.executor.submit(self.request, path, params).result)
+
+    def claim(self, name):
+        data = self.ask('/front/claim')
+        return data['index'], data['first'] == (name == self.name)
+
+    def release(self, index):
+        self.send('/front/release', index=index)
+
+    def has_pending(self):
+        return self.ask('/front/pending')['pending']
+
+    def record(self, index, sente, winner, gameover):
+        self.send('/front/record', index=index, sente=sente, winner=winner, gameover=gameover)
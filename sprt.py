@@ -0,0 +1,64 @@
+import math
+
+
+def expected_score(elo):
+    """Returns the expected score of a player stronger by the elo difference.
+    """
+    return 1 / (1 + 10 ** (-elo / 400))
+
+class SPRT:
+    """Sequential probability ratio test of the elo difference between two players.
+
+    The log-likelihood ratio of H1 (the difference is elo1) against H0 (the difference is elo0)
+    is approximated from the numbers of wins, draws and losses (GSPRT),
+    and the test ends when it crosses the bound of alpha or beta.
+    """
+    def __init__(self, elo0=0, elo1=5, alpha=0.05, beta=0.05):
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.alpha = alpha
+        self.beta = beta
+
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+
+        self.llr = 0.0
+
+        # 'H0' or 'H1' once a bound is crossed, otherwise None.
+        self.decision = None
+
+    def update(self, wins, draws, losses):
+        """Compute the log-likelihood ratio from the results so far, and judge whether the test ends.
+
+        # Arguments
+            wins: The number of wins of the player.
+            draws: The number of draws.
+            losses: The number of losses of the player.
+
+        # Returns
+            The decision, i.e. 'H0', 'H1' or None.
+        """
+        if self.decision is not None:
+            return self.decision
+
+        n = wins + draws + losses
+        if n == 0:
+            return None
+
+        score = (wins + draws / 2) / n
+        variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / n
+
+        # The variance is unknown until the results differ.
+        if variance == 0:
+            return None
+
+        s0 = expected_score(self.elo0)
+        s1 = expected_score(self.elo1)
+        self.llr = n * (s1 - s0) * (2 * score - s0 - s1) / (2 * variance)
+
+        if self.llr >= self.upper:
+            self.decision = 'H1'
+        elif self.llr <= self.lower:
+            self.decision = 'H0'
+
+        return self.decision
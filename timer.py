@@ -0,0 +1,74 @@
+class TimerWheel:
+    """Deadlines of many keys, kept in a hashed timer wheel.
+
+    A deadline is put in the bucket of its tick, so scheduling and cancelling take constant time,
+    and expiring takes time proportional to the deadlines in the buckets that passed.
+    """
+    def __init__(self, resolution=100, slots=1024):
+        # Milliseconds per tick.
+        self.resolution = resolution
+
+        self.buckets = [set() for _ in range(slots)]
+
+        # The deadline of each key in milliseconds, and the index of the bucket it is in.
+        self.deadlines = { }
+
+        # The last tick whose bucket is completely expired.
+        self.current = None
+
+    def schedule(self, key, deadline):
+        """Set the deadline of the key, replacing the previous one.
+
+        # Arguments
+            key: The key, e.g. the id of a game.
+            deadline: The deadline in milliseconds.
+        """
+        tick = deadline // self.resolution
+        if self.current is not None:
+            # A deadline that already passed expires at the next expiry.
+            tick = max(tick, self.current + 1)
+
+        index = tick % len(self.buckets)
+        self.deadlines[key] = (deadline, index)
+        self.buckets[index].add(key)
+
+    def cancel(self, key):
+        # The key stays in the bucket, and is discarded when the bucket is expired.
+        self.deadlines.pop(key, None)
+
+    def expire(self, now):
+        """Remove the keys whose deadlines passed.
+
+        # Arguments
+            now: The current time in milliseconds.
+
+        # Returns
+            The list of the keys whose deadlines passed.
+        """
+        tick = now // self.resolution
+        if self.current is None:
+            self.current = tick - 1
+
+        expired = []
+
+        # Every bucket is visited at most once, even if many ticks passed.
+        first = max(self.current + 1, tick - len(self.buckets) + 1)
+        for t in range(first, tick + 1):
+            index = t % len(self.buckets)
+            bucket = self.buckets[index]
+
+            for key in list(bucket):
+                entry = self.deadlines.get(key)
+
+                if entry is None or entry[1] != index:
+                    # Cancelled, or moved to another bucket.
+                    bucket.discard(key)
+                elif entry[0] <= now:
+                    bucket.discard(key)
+                    del self.deadlines[key]
+                    expired.append(key)
+
+        # The bucket of the current tick may have deadlines later in this tick, so visit it again next time.
+        self.current = tick - 1
+
+        return expired